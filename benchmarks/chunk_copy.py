@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""Micro-benchmark of the chunk hot path of filesender_sagc.py: bytes allocated
+(i.e. copied) and time per chunk for reading a chunk and computing its HMAC-SHA1
+signature, before and after switching to a reused buffer and streaming HMAC.
+
+before: fin.read() allocates a new bytes per chunk, then call() concatenates the
+        signed url with the whole chunk (signed += chunk) before hashing
+after:  readinto() a preallocated bytearray, the HMAC is fed the url and then a
+        memoryview of the buffer, the same memoryview goes to requests
+
+usage: python benchmarks/chunk_copy.py [--chunk-size BYTES] [--size BYTES]
+"""
+
+import argparse
+import hashlib
+import hmac
+import os
+import tempfile
+import time
+import tracemalloc
+
+
+def before(fin, offset, length, key, signed_prefix):
+    fin.seek(offset)
+    data = fin.read(length)
+    signed = signed_prefix
+    signed += bytes('&', 'ascii')
+    signed += data
+    return data, hmac.new(key, signed, hashlib.sha1).hexdigest()
+
+
+def after(fin, offset, length, key, signed_prefix, buf):
+    data = memoryview(buf)[:length]
+    fin.seek(offset)
+    n = 0
+    while n < length:
+        n += fin.readinto(data[n:])
+    signature = hmac.new(key, signed_prefix, hashlib.sha1)
+    signature.update(b'&')
+    signature.update(data)
+    return data, signature.hexdigest()
+
+
+def run(name, fpath, size, chunk_size, step):
+    key = b'0123456789abcdef0123456789abcdef'
+    signed_prefix = b'put&filesender.example.org/rest.php/file/1/chunk/0?key=x&remote_user=u&roundtriptoken=t&timestamp=1'
+    buf = bytearray(chunk_size)
+    n_chunks = 0
+    peak = 0
+    elapsed = 0
+    with open(fpath, mode='rb', buffering=0) as fin:
+        for offset in range(0, size, chunk_size):
+            length = min(chunk_size, size - offset)
+            tracemalloc.start()
+            base, _ = tracemalloc.get_traced_memory()
+            start = time.perf_counter()
+            if step is before:
+                data, signature = before(fin, offset, length, key, signed_prefix)
+            else:
+                data, signature = after(fin, offset, length, key, signed_prefix, buf)
+            elapsed += time.perf_counter() - start
+            _, chunk_peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del data
+            peak = max(peak, chunk_peak - base)
+            n_chunks += 1
+    print(f"{name:8s} {peak:>14,} bytes copied per chunk "
+          f"{elapsed/n_chunks*1000:8.2f} ms per chunk  {size/elapsed/1024**2:8.1f} MB/s")
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="bytes copied per chunk, before/after reusable chunk buffers")
+    p.add_argument("--chunk-size", type=int, default=5*1024*1024, help="chunk size, default 5 MiB")
+    p.add_argument("--size", type=int, default=256*1024*1024, help="size of the test file, default 256 MiB")
+    args = p.parse_args()
+
+    with tempfile.NamedTemporaryFile() as tmp:
+        block = os.urandom(1024*1024)
+        for _ in range(0, args.size, len(block)):
+            tmp.write(block)
+        tmp.flush()
+        size = os.path.getsize(tmp.name)
+        print(f"{size:,} bytes in chunks of {args.chunk_size:,} bytes")
+        run("before", tmp.name, size, args.chunk_size, before)
+        run("after", tmp.name, size, args.chunk_size, after)
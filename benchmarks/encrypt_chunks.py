@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""Throughput of the chunk path of filesender_sagc.py with and without --encrypt:
+reading chunks from a file (plaintext mode) against reading and encrypting them with
+AES-256-CBC as the upload workers do, in 1..N worker processes. An upload keeps
+encryption hidden behind the network as long as the encrypting rate of its workers
+stays above the link rate; end to end against the mock server, compare
+
+    python benchmarks/run_benchmarks.py --output plain.json
+    python benchmarks/run_benchmarks.py --client-args=--encrypt --compare plain.json
+
+usage: python benchmarks/encrypt_chunks.py [--chunk-size BYTES] [--size BYTES] [--procs 1,2,4]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from multiprocessing import Pool
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import filesender_sagc  # noqa: E402
+
+
+def init(key):
+    filesender_sagc.load_cryptography()
+    filesender_sagc.encryption_key = key
+
+
+def read_chunks(task):
+    """reads (and encrypts) every procs-th chunk of the file, like one upload worker"""
+    fpath, size, chunk_size, start, step, encrypt = task
+    buf = memoryview(bytearray(chunk_size))
+    crypt_buf = bytearray(filesender_sagc.encrypted_length(chunk_size) + 15)
+    n = 0
+    with open(fpath, mode='rb', buffering=0) as fin:
+        for offset in range(start * chunk_size, size, step * chunk_size):
+            data = buf[:min(chunk_size, size - offset)]
+            filesender_sagc.readinto_at(fin, data, offset)
+            if encrypt:
+                data = filesender_sagc.encrypt_chunk(filesender_sagc.encryption_key, data, crypt_buf)
+            n += len(data)
+    return n
+
+
+def run(name, fpath, size, chunk_size, procs, encrypt, key):
+    with Pool(procs, initializer=init, initargs=(key,)) as pool:
+        start = time.perf_counter()
+        pool.map(read_chunks, [(fpath, size, chunk_size, i, procs, encrypt) for i in range(procs)])
+        elapsed = time.perf_counter() - start
+    print(f"{name:10s} x{procs:<3d} {size/elapsed/1024**2:9.1f} MB/s")
+    return size / elapsed
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="chunk read rate in plaintext and --encrypt mode")
+    p.add_argument("--chunk-size", type=int, default=5*1024*1024, help="chunk size, default 5 MiB")
+    p.add_argument("--size", type=int, default=512*1024*1024, help="size of the test file, default 512 MiB")
+    p.add_argument("--procs", default=f"1,{os.cpu_count() or 1}", help="comma separated numbers of workers")
+    args = p.parse_args()
+
+    filesender_sagc.load_cryptography()
+    key = filesender_sagc.encryption_key_from_password("benchmark", "salt")
+    with tempfile.NamedTemporaryFile() as tmp:
+        block = os.urandom(1024*1024)
+        for _ in range(0, args.size, len(block)):
+            tmp.write(block)
+        tmp.flush()
+        size = os.path.getsize(tmp.name)
+        print(f"{size:,} bytes in chunks of {args.chunk_size:,} bytes, {os.cpu_count()} cpus")
+        for procs in sorted({int(n) for n in args.procs.split(",")}):
+            plain = run("plaintext", tmp.name, size, args.chunk_size, procs, False, key)
+            encrypted = run("encrypted", tmp.name, size, args.chunk_size, procs, True, key)
+            print(f"{'':10s}      encryption costs {(1 - encrypted/plain)*100:.0f}% of the read rate")
@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+"""Local stand-in for the FileSender rest.php used by filesender_sagc.py, so uploads
+can be tuned and benchmarked without touching a production server.
+
+implements:  GET    /rest.php/info
+             POST   /rest.php/transfer
+             PUT    /rest.php/file/{id}/chunk/{offset}
+             PUT    /rest.php/file/{id}                  (file complete)
+             PUT    /rest.php/transfer/{id}              (transfer complete)
+             DELETE /rest.php/transfer/{id}
+             GET    /rest.php/mock/stats                 (counters, not signed)
+
+Every request is checked like FileSender does: HMAC-SHA1 with the api key over
+method&host/path?sorted_args[&body], the chunk keys and round trip tokens must match
+the transfer, and a file is only complete once all of its bytes arrived. Chunks of
+encrypted transfers (--encrypt) must have the size of an IV plus the padded
+ciphertext of their plaintext chunk, they are stored in encrypted chunk positions.
+
+Chunks are discarded unless --store is given, so the benchmark measures the client
+and not the disk of the mock. Latency, bandwidth and errors can be injected:
+
+    --latency 0.05        seconds added to every chunk PUT
+    --bandwidth 100M      total receive rate of all connections, bytes/s
+    --error-rate 0.01     fraction of chunk PUTs answered with 503
+    --error-every 50      every 50th chunk PUT answered with 503
+    --drop-rate 0.001     fraction of chunk PUTs whose connection is closed without reply
+
+usage: python benchmarks/mock_filesender.py [--port 8765] [--apikey secret] [...]
+The first line on stdout is "listening on <base_url>", with --port 0 a free port is used.
+"""
+
+import argparse
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+READ_SIZE = 256*1024
+
+
+def parse_size(size):
+    """'100M' -> 104857600, same units as --max-rate of filesender_sagc.py"""
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+    size = str(size).strip().upper().rstrip('B')
+    try:
+        if size and size[-1] in units:
+            return int(float(size[:-1]) * units[size[-1]])
+        return int(float(size))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size: {size}")
+
+
+class Bandwidth:
+    """Paces the bytes read from all connections to a shared rate."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next_free = time.monotonic()
+
+    def consume(self, n):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_free)
+            self.next_free = start + n / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+class MockFileSender:
+    """State of the mock server: transfers, files, received chunks and counters."""
+
+    def __init__(self, args):
+        self.args = args
+        self.key = args.apikey.encode()
+        self.ids = itertools.count(1000)
+        self.lock = threading.Lock()
+        self.transfers = {}
+        self.files = {}
+        self.random = random.Random(args.seed)
+        self.bandwidth = Bandwidth(args.bandwidth)
+        self.stats = {"transfers": 0, "files_complete": 0, "transfers_complete": 0, "deleted": 0,
+                      "chunks": 0, "chunk_bytes": 0, "duplicate_chunks": 0, "requests": 0,
+                      "bad_signatures": 0, "errors_injected": 0, "drops_injected": 0}
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.stats[name] += n
+
+    def inject(self):
+        """Returns None, 'error' or 'drop' for the next chunk PUT."""
+        with self.lock:
+            n = self.stats["chunks"] + self.stats["errors_injected"] + self.stats["drops_injected"] + 1
+            if self.args.error_every and n % self.args.error_every == 0:
+                return "error"
+            r = self.random.random()
+        if r < self.args.drop_rate:
+            return "drop"
+        if r < self.args.drop_rate + self.args.error_rate:
+            return "error"
+        return None
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # replies are small and written in one go, without this the client waits for delayed acks
+    disable_nagle_algorithm = True
+    server_version = "MockFileSender"
+
+    @property
+    def mock(self):
+        return self.server.mock
+
+    def log_message(self, format, *args):
+        if self.mock.args.verbose:
+            super().log_message(format, *args)
+
+    def reply(self, code, obj, headers={}):
+        body = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def error(self, code, message):
+        self.reply(code, {"message": message})
+
+    def route(self):
+        """Splits the url, returns the path below rest.php and the query args."""
+        u = urlsplit(self.path)
+        path = u.path.split("/rest.php", 1)[-1]
+        return u, path, parse_qsl(u.query, keep_blank_values=True)
+
+    def read_signed_body(self, method, u, query, keep=True):
+        """Reads the request body while computing the expected signature,
+        returns (body, signature ok). The body is None if keep is False.
+        """
+        rest = "&".join(sorted(k+"="+v for k, v in query if k != "signature"))
+        signature = hmac.new(self.mock.key, (method+"&"+self.headers["Host"]+u.path+"?"+rest).encode(), hashlib.sha1)
+        length = int(self.headers.get("Content-Length", 0))
+        parts = [] if keep else None
+        if length:
+            signature.update(b"&")
+        while length > 0:
+            data = self.rfile.read(min(READ_SIZE, length))
+            if not data:
+                break
+            length -= len(data)
+            self.mock.bandwidth.consume(len(data))
+            signature.update(data)
+            if keep:
+                parts.append(data)
+        body = b"".join(parts) if keep else None
+        ok = hmac.compare_digest(signature.hexdigest(), dict(query).get("signature", ""))
+        if not ok:
+            self.mock.count("bad_signatures")
+        return body, ok
+
+    def do_GET(self):
+        self.mock.count("requests")
+        u, path, query = self.route()
+        if path == "/info":
+            return self.reply(200, {"upload_chunk_size": self.mock.args.chunk_size,
+                                    "upload_crypted_chunk_size": encrypted_length(self.mock.args.chunk_size)})
+        if path == "/mock/stats":
+            with self.mock.lock:
+                stats = dict(self.mock.stats)
+            return self.reply(200, stats)
+        self.error(404, "not found")
+
+    def do_POST(self):
+        self.mock.count("requests")
+        u, path, query = self.route()
+        body, ok = self.read_signed_body("post", u, query)
+        if not ok:
+            return self.error(403, "auth_remote_signature_check_failed")
+        if path != "/transfer":
+            return self.error(404, "not found")
+        d = json.loads(body)
+        mock = self.mock
+        with mock.lock:
+            tid = next(mock.ids)
+            files = [{"id": next(mock.ids), "uid": "uid%d" % next(mock.ids), "name": f["name"], "size": f["size"]}
+                     for f in d["files"]]
+            transfer = {"id": tid, "roundtriptoken": "rtt%d" % tid, "user_email": d["from"],
+                        "subject": d.get("subject", ""), "message": d.get("message", ""), "files": files,
+                        "recipients": [{"email": r, "token": "tok%d%d" % (tid, i),
+                                        "download_url": "%s://%s/?s=download&token=tok%d%d" % (
+                                            "http", self.headers["Host"], tid, i)}
+                                       for i, r in enumerate(d["recipients"])]}
+            mock.transfers[tid] = transfer
+            for f in files:
+                mock.files[f["id"]] = dict(f, transfer=tid, chunks={}, complete=False,
+                                           encrypted=bool(d.get("encryption")))
+            mock.stats["transfers"] += 1
+        self.reply(201, transfer, {"Location": "/transfer/%d" % tid})
+
+    def do_PUT(self):
+        self.mock.count("requests")
+        u, path, query = self.route()
+        parts = path.strip("/").split("/")
+        args = dict(query)
+        if len(parts) == 4 and parts[0] == "file" and parts[2] == "chunk":
+            return self.put_chunk(u, query, args, int(parts[1]), int(parts[3]))
+        body, ok = self.read_signed_body("put", u, query)
+        if not ok:
+            return self.error(403, "auth_remote_signature_check_failed")
+        mock = self.mock
+        with mock.lock:
+            if len(parts) == 2 and parts[0] == "file":
+                f = mock.files.get(int(parts[1]))
+                if f is None or args.get("key") != f["uid"]:
+                    return self.error(404, "file_not_found")
+                received = sum(f["chunks"].values())
+                if received != f["size"]:
+                    return self.error(400, "file_incomplete %s %d/%d bytes" % (f["name"], received, f["size"]))
+                if not f["complete"]:
+                    f["complete"] = True
+                    mock.stats["files_complete"] += 1
+                return self.reply(200, True)
+            if len(parts) == 2 and parts[0] == "transfer":
+                t = mock.transfers.get(int(parts[1]))
+                if t is None or args.get("key") not in [f["uid"] for f in t["files"]]:
+                    return self.error(404, "transfer_not_found")
+                incomplete = [f["name"] for f in t["files"] if not mock.files[f["id"]]["complete"]]
+                if incomplete:
+                    return self.error(400, "transfer_files_incomplete %s" % ", ".join(incomplete[:10]))
+                mock.stats["transfers_complete"] += 1
+                return self.reply(200, t)
+        self.error(404, "not found")
+
+    def put_chunk(self, u, query, args, file_id, offset):
+        mock = self.mock
+        f = mock.files.get(file_id)
+        if f is None:
+            return self.error(404, "file_not_found")
+        t = mock.transfers[f["transfer"]]
+        store = mock.args.store is not None
+        body, ok = self.read_signed_body("put", u, query, keep=store)
+        if not ok:
+            return self.error(403, "auth_remote_signature_check_failed")
+        if args.get("key") != f["uid"] or args.get("roundtriptoken") != t["roundtriptoken"]:
+            return self.error(403, "chunk_key_mismatch")
+        length = int(self.headers.get("Content-Length", 0))
+        position = offset
+        if f["encrypted"]:
+            # the plaintext length of the chunk is what counts towards the file
+            plain = min(mock.args.chunk_size, f["size"] - offset)
+            if offset % mock.args.chunk_size or plain <= 0 or length != encrypted_length(plain):
+                return self.error(400, "encrypted_chunk_size_mismatch %d+%d" % (offset, length))
+            position = offset // mock.args.chunk_size * encrypted_length(mock.args.chunk_size)
+            length = plain
+        elif offset + length > f["size"] or length > mock.args.chunk_size:
+            return self.error(400, "chunk_out_of_range %d+%d" % (offset, length))
+        if mock.args.latency:
+            time.sleep(mock.args.latency)
+        fault = mock.inject()
+        if fault == "drop":
+            mock.count("drops_injected")
+            self.close_connection = True
+            return
+        if fault == "error":
+            mock.count("errors_injected")
+            return self.error(503, "injected error")
+        if store:
+            fpath = os.path.join(mock.args.store, str(t["id"]), f["name"])
+            os.makedirs(os.path.dirname(fpath), exist_ok=True)
+            fd = os.open(fpath, os.O_WRONLY | os.O_CREAT, 0o644)
+            try:
+                os.pwrite(fd, body, position)
+            finally:
+                os.close(fd)
+        with mock.lock:
+            if offset in f["chunks"]:
+                mock.stats["duplicate_chunks"] += 1
+            f["chunks"][offset] = length
+            mock.stats["chunks"] += 1
+            mock.stats["chunk_bytes"] += length
+        self.reply(200, True)
+
+    def do_DELETE(self):
+        self.mock.count("requests")
+        u, path, query = self.route()
+        _, ok = self.read_signed_body("delete", u, query)
+        if not ok:
+            return self.error(403, "auth_remote_signature_check_failed")
+        parts = path.strip("/").split("/")
+        mock = self.mock
+        with mock.lock:
+            t = mock.transfers.pop(int(parts[1]), None) if parts[0] == "transfer" else None
+            if t is None:
+                return self.error(404, "transfer_not_found")
+            for f in t["files"]:
+                mock.files.pop(f["id"], None)
+            mock.stats["deleted"] += 1
+        self.reply(200, True)
+
+
+def encrypted_length(length):
+    """FileSender's AES-CBC chunks: 16 byte IV and the PKCS#7 padded ciphertext"""
+    return 16 + (length // 16 + 1) * 16
+
+
+def make_parser():
+    p = argparse.ArgumentParser(description="local mock of the FileSender REST API")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", default=8765, type=int, help="0 picks a free port")
+    p.add_argument("--apikey", default="secret", help="api key used to check signatures")
+    p.add_argument("--chunk-size", default=5*1024*1024, type=parse_size, help="upload_chunk_size returned by /info")
+    p.add_argument("--latency", default=0.0, type=float, help="seconds added to every chunk PUT")
+    p.add_argument("--bandwidth", default=0, type=parse_size, help="total receive rate in bytes/s, e.g. 100M (0: unlimited)")
+    p.add_argument("--error-rate", default=0.0, type=float, help="fraction of chunk PUTs answered with 503")
+    p.add_argument("--error-every", default=0, type=int, help="answer every Nth chunk PUT with 503")
+    p.add_argument("--drop-rate", default=0.0, type=float, help="fraction of chunk PUTs closed without a reply")
+    p.add_argument("--seed", default=None, type=int, help="seed of the injected errors")
+    p.add_argument("--store", type=str, help="directory to write received files to (default: discard)")
+    p.add_argument("-v", "--verbose", action="store_true", help="log every request")
+    return p
+
+
+def serve(args):
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    server.daemon_threads = True
+    server.mock = MockFileSender(args)
+    host, port = server.server_address[:2]
+    print(f"listening on http://{host}:{port}/rest.php", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(server.mock.stats), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    serve(make_parser().parse_args())
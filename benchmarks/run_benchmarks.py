@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""End-to-end upload benchmark of filesender_sagc.py against the local mock server
+(benchmarks/mock_filesender.py). No production server is touched.
+
+Synthetic workloads, created once in --workdir:
+
+    huge    one sparse file (--huge-size), measures the chunk path without the disk
+    tiny    thousands of small files (--tiny-count), measures per-file and per-set overhead
+    mixed   the shape of a sequencing run: a few large sparse fastq.gz files and a few
+            hundred small run files (xml, csv, InterOp bins, logs)
+
+Every workload is uploaded once per engine and concurrency (and --repeat times).
+Each run records wall time, MB/s, CPU seconds per GB and the peak RSS of the client
+(the largest single process, pool workers included), and checks with the mock that
+all bytes and transfers arrived. Results are written to a JSON file, --compare prints
+the change of MB/s against an earlier result file.
+
+usage: python benchmarks/run_benchmarks.py [--workloads huge,tiny,mixed] [--engines pool,async]
+                                           [--procs 4,16] [--latency 0.02] [--bandwidth 0]
+                                           [--output results.json] [--compare old.json]
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CLIENT = os.path.join(os.path.dirname(HERE), "filesender_sagc.py")
+MOCK = os.path.join(HERE, "mock_filesender.py")
+sys.path.insert(0, HERE)
+from mock_filesender import parse_size  # noqa: E402
+
+APIKEY = "benchmark-key"
+USERNAME = "benchmark@example.org"
+RECIPIENT = "recipient@example.org"
+
+
+def make_sparse(fpath, size):
+    with open(fpath, "wb") as fout:
+        fout.truncate(size)
+
+
+def make_random(fpath, size, rng):
+    with open(fpath, "wb") as fout:
+        fout.write(rng.randbytes(size))
+
+
+def make_workload(name, workdir, args):
+    """Creates the files of a workload once, returns the list of paths."""
+    wdir = os.path.join(workdir, name)
+    stamp = os.path.join(wdir, ".complete")
+    rng = random.Random(name)
+    if not os.path.exists(stamp):
+        shutil.rmtree(wdir, ignore_errors=True)
+        os.makedirs(wdir)
+        if name == "huge":
+            make_sparse(os.path.join(wdir, "huge.bin"), args.huge_size)
+        elif name == "tiny":
+            for i in range(args.tiny_count):
+                make_random(os.path.join(wdir, f"tiny_{i:06d}.txt"), rng.randint(1, 16*1024), rng)
+        elif name == "mixed":
+            for i in range(args.mixed_fastq):
+                for read in (1, 2):
+                    make_sparse(os.path.join(wdir, f"S{i+1}_L001_R{read}_001.fastq.gz"), args.mixed_fastq_size)
+            for i in range(args.mixed_small):
+                kind = ["RunInfo.xml", "SampleSheet.csv", "InterOp.bin", "log.txt"][i % 4]
+                make_random(os.path.join(wdir, f"run_{i:04d}_{kind}"), rng.randint(512, 2*1024*1024), rng)
+        else:
+            raise ValueError(f"unknown workload: {name}")
+        open(stamp, "w").close()
+    return sorted(os.path.join(wdir, f) for f in os.listdir(wdir) if not f.startswith("."))
+
+
+def start_mock(args):
+    """Starts the mock server on a free port, returns (process, base_url)."""
+    cmd = [sys.executable, MOCK, "--port", "0", "--apikey", APIKEY,
+           "--chunk-size", str(args.chunk_size), "--latency", str(args.latency),
+           "--bandwidth", str(args.bandwidth), "--error-rate", str(args.error_rate),
+           "--seed", "1"]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+    line = proc.stdout.readline()
+    if not line.startswith("listening on "):
+        proc.kill()
+        raise RuntimeError(f"mock server did not start: {line!r}")
+    return proc, line.split()[-1]
+
+
+def mock_stats(base_url):
+    import urllib.request
+    with urllib.request.urlopen(base_url + "/mock/stats") as response:
+        return json.load(response)
+
+
+def write_config(home, base_url):
+    os.makedirs(os.path.join(home, ".filesender"), exist_ok=True)
+    with open(os.path.join(home, ".filesender", "filesender.py.ini"), "w") as fout:
+        fout.write(f"[system]\nbase_url = {base_url}\n\n"
+                   f"[user]\nusername = {USERNAME}\napikey = {APIKEY}\n\n"
+                   f"[recipients]\nrecipients = {RECIPIENT}\n")
+
+
+def run_client(files, engine, procs, home, outdir, extra):
+    """Uploads files with one client process, returns (seconds, rusage, returncode, output)."""
+    cmd = [sys.executable, CLIENT, "-k", "--engine", engine, "--report", os.path.join(outdir, "report")]
+    if engine == "async":
+        cmd += ["--max-inflight", str(procs)]
+    else:
+        cmd += ["-n", str(procs)]
+    cmd += extra + files
+    # the password of --client-args=--encrypt
+    env = dict(os.environ, HOME=home, FILESENDER_ENCRYPTION_PASSWORD="benchmark")
+    log = tempfile.TemporaryFile(mode="w+")
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, env=env, stdout=log, stderr=subprocess.STDOUT)
+    # wait4 gives the resource usage of this run alone: cpu of the client and its
+    # reaped pool workers, maxrss of the largest of them
+    _, status, rusage = os.wait4(proc.pid, 0)
+    seconds = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    log.seek(0)
+    return seconds, rusage, proc.returncode, log.read()
+
+
+def benchmark(args):
+    workdir = args.workdir or os.path.join(tempfile.gettempdir(), "filesender-benchmarks")
+    os.makedirs(workdir, exist_ok=True)
+    mock, base_url = start_mock(args)
+    home = tempfile.mkdtemp(prefix="home-", dir=workdir)
+    write_config(home, base_url)
+    results = []
+    try:
+        for workload in args.workloads.split(","):
+            files = make_workload(workload, workdir, args)
+            size = sum(os.path.getsize(f) for f in files)
+            print(f"{workload}: {len(files):,} files, {size/1024**3:.2f} GB", flush=True)
+            for engine in args.engines.split(","):
+                for procs in [int(n) for n in args.procs.split(",")]:
+                    for repeat in range(args.repeat):
+                        before = mock_stats(base_url)
+                        outdir = tempfile.mkdtemp(prefix="run-", dir=workdir)
+                        seconds, rusage, code, output = run_client(
+                            files, engine, procs, home, outdir, shlex.split(args.client_args))
+                        shutil.rmtree(outdir, ignore_errors=True)
+                        after = mock_stats(base_url)
+                        server = {k: after[k] - before[k] for k in after}
+                        cpu = rusage.ru_utime + rusage.ru_stime
+                        result = {
+                            "workload": workload,
+                            "engine": engine,
+                            "procs": procs,
+                            "repeat": repeat,
+                            "files": len(files),
+                            "bytes": size,
+                            "seconds": round(seconds, 3),
+                            "mb_per_s": round(size / 1024**2 / seconds, 2),
+                            "cpu_seconds": round(cpu, 3),
+                            "cpu_seconds_per_gb": round(cpu / (size / 1024**3), 3) if size else None,
+                            "peak_rss_mb": round(rusage.ru_maxrss / 1024, 1),
+                            "returncode": code,
+                            # the mock only completes a file once all of its bytes arrived
+                            "verified": code == 0 and server["files_complete"] == len(files)
+                            and server["transfers_complete"] > 0,
+                            "server": server,
+                        }
+                        if code != 0:
+                            result["output"] = output[-4000:]
+                        results.append(result)
+                        print(f"  {engine:5s} x{procs:<4d} {result['mb_per_s']:9.1f} MB/s "
+                              f"{result['cpu_seconds_per_gb'] or 0:7.2f} cpu s/GB {result['peak_rss_mb']:8.1f} MB rss "
+                              f"{'ok' if result['verified'] else 'FAILED'}", flush=True)
+    finally:
+        mock.terminate()
+        mock.wait()
+        shutil.rmtree(home, ignore_errors=True)
+    return results
+
+
+def compare(results, old_path):
+    with open(old_path) as fin:
+        old = {(r["workload"], r["engine"], r["procs"]): r for r in json.load(fin)["results"]}
+    print(f"\nMB/s compared to {old_path}:")
+    for r in results:
+        o = old.get((r["workload"], r["engine"], r["procs"]))
+        if o is None:
+            continue
+        print(f"  {r['workload']:6s} {r['engine']:5s} x{r['procs']:<4d} {o['mb_per_s']:9.1f} -> "
+              f"{r['mb_per_s']:9.1f} MB/s ({(r['mb_per_s']/o['mb_per_s'] - 1)*100:+.1f}%)")
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="end-to-end upload benchmarks against the local mock server")
+    p.add_argument("--workloads", default="huge,tiny,mixed", help="comma separated: huge, tiny, mixed")
+    p.add_argument("--engines", default="pool,async", help="comma separated: pool, async")
+    p.add_argument("--procs", default="4,16", help="comma separated -n (pool) / --max-inflight (async) values")
+    p.add_argument("--repeat", default=1, type=int)
+    p.add_argument("--client-args", default="", help="extra arguments for filesender_sagc.py")
+    p.add_argument("--workdir", type=str, help="where workloads are created and kept between runs")
+    p.add_argument("--huge-size", default="8G", type=parse_size)
+    p.add_argument("--tiny-count", default=5000, type=int)
+    p.add_argument("--mixed-fastq", default=4, type=int, help="number of read pairs of the mixed workload")
+    p.add_argument("--mixed-fastq-size", default="512M", type=parse_size)
+    p.add_argument("--mixed-small", default=300, type=int)
+    p.add_argument("--chunk-size", default="5M", type=parse_size, help="upload_chunk_size of the mock server")
+    p.add_argument("--latency", default=0.0, type=float, help="mock: seconds added to every chunk PUT")
+    p.add_argument("--bandwidth", default="0", type=parse_size, help="mock: total receive rate, e.g. 1G")
+    p.add_argument("--error-rate", default=0.0, type=float, help="mock: fraction of chunk PUTs answered with 503")
+    p.add_argument("--output", "-o", type=str, help="result JSON file (default: benchmarks/results-<time>.json)")
+    p.add_argument("--compare", type=str, help="earlier result JSON file to compare MB/s with")
+    args = p.parse_args()
+
+    results = benchmark(args)
+    output = args.output or os.path.join(HERE, time.strftime("results-%Y%m%d-%H%M%S.json"))
+    with open(output, "w") as fout:
+        json.dump({
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "settings": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+            "results": results,
+        }, fout, indent=2)
+    print(f"results written to {output}")
+    if args.compare:
+        compare(results, args.compare)
+    if not all(r["verified"] for r in results):
+        sys.exit(1)
@@ -4,8 +4,23 @@ import requests
 import xml.etree.ElementTree as ET
 from html.parser import HTMLParser
 import subprocess
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
 from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from email.message import Message
+from urllib.parse import urlsplit, parse_qs
+import datetime
+import json
+import os
+import struct
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import urllib3
+import zipfile
+import zlib
 
 def download_html(url):
     try:
@@ -17,6 +32,16 @@ def download_html(url):
         return None
 
 
+def row_size(value):
+    """bytes of a data-size attribute, None when missing or unreadable"""
+    if not value:
+        return None
+    try:
+        return parse_size(value)
+    except ArgumentTypeError:
+        return None
+
+
 class MyHTMLParser(HTMLParser):
     def __init__(self):
         super().__init__()
@@ -24,6 +49,8 @@ class MyHTMLParser(HTMLParser):
         self.target_class = ""
         self.captured_data = []
         self.file_ids = []
+        # {"id", "name", "size"} of every row, name and size None when the page has no data-name/data-size
+        self.files = []
 
     # def handle_starttag(self, tag, attrs):
     #     if tag == "span":
@@ -37,11 +64,12 @@ class MyHTMLParser(HTMLParser):
 
     def handle_starttag(self, tag, attrs):
         if tag == "tr":
-            for attr in attrs:
-                if attr[0] == self.target_class:
-                    print(attr[0], attr[1])
-                    self.file_ids.append(attr[1])
-                    self.capture_data = True
+            attrs = dict(attrs)
+            if self.target_class in attrs:
+                self.file_ids.append(attrs[self.target_class])
+                self.files.append({"id": attrs[self.target_class], "name": attrs.get("data-name"),
+                                   "size": row_size(attrs.get("data-size"))})
+                self.capture_data = True
 
     def handle_endtag(self, tag):
         if tag == "tr" and self.capture_data:
@@ -77,6 +105,18 @@ def handle_args():
     p.add_argument("--outdir", "-o", default="./", help="Output directory")
     p.add_argument("--single", "-s", choices=["tar", "zip"], 
                    help="Download data in a single archive file (either zip or tar). If specified, overrides --parallel")
+    p.add_argument("--engine", choices=["native", "wget"], default="native",
+                   help="native: in-process downloads over pooled keep-alive connections (default), "
+                        "wget: one wget process per file")
+    p.add_argument("--segments", type=int, default=SEGMENTS,
+                   help=f"native engine: fetch a large file in up to this many concurrent byte ranges "
+                        f"when the server accepts Range requests, 1 disables, default={SEGMENTS}")
+    p.add_argument("--min-segment-size", type=parse_size, default=MIN_SEGMENT,
+                   help=f"native engine: smallest byte range of a segmented file, e.g. 256M, default={MIN_SEGMENT // 1024**2}M")
+    p.add_argument("--extract", "-x", action="store_true",
+                   help="native engine with --single: extract the archive into --outdir while it downloads, "
+                        "the archive itself is not written")
+    p.add_argument("--results", help="Write the per-file results (url, path, bytes, seconds, status, error) to this JSON file")
     return p.parse_args()
 
 OUTDIR="./"
@@ -86,6 +126,621 @@ def download_url(url):
     wget_proc = subprocess.Popen(wget_cmd, shell=True)
     wget_proc.communicate()
 
+
+# size of the blocks read from the response and of the output file buffer
+DOWNLOAD_BLOCK = 1024*1024
+DOWNLOAD_BUFFER = 8*1024*1024
+# (connect, read) timeouts in seconds
+DOWNLOAD_TIMEOUT = (30, 300)
+# files of at least 2 * MIN_SEGMENT bytes are fetched in up to SEGMENTS concurrent byte ranges
+SEGMENTS = 4
+MIN_SEGMENT = 64*1024*1024
+# bytes of a range between two records of the state file
+CHECKPOINT = 64*1024*1024
+# state file of the native engine in --outdir, see DownloadState
+STATE_FILE = ".filesender_download.state"
+
+_local = threading.local()
+
+def get_session():
+    """requests.Session of the calling thread, its keep-alive connection is reused
+    for every file the thread downloads"""
+    session = getattr(_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _local.session = session
+    return session
+
+def disposition_filename(header):
+    """file name of a Content-Disposition header (filename* or filename), None without one"""
+    if not header:
+        return None
+    msg = Message()
+    msg["content-disposition"] = header
+    name = msg.get_filename()
+    if not name:
+        return None
+    # never write outside of the output directory
+    name = os.path.basename(name.replace("\\", "/"))
+    return name if name not in ("", ".", "..") else None
+
+def fallback_filename(url):
+    """name for a response without Content-Disposition: the files_ids of a download.php
+    link, else the last part of the url path"""
+    parts = urlsplit(url)
+    files_ids = parse_qs(parts.query).get("files_ids")
+    if files_ids:
+        return files_ids[0].replace(",", "_")
+    return os.path.basename(parts.path) or "download"
+
+def parse_size(size):
+    """'100M' -> 104857600"""
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    size = str(size).strip().upper().rstrip("B")
+    try:
+        if size and size[-1] in units:
+            return int(float(size[:-1]) * units[size[-1]])
+        return int(float(size))
+    except ValueError:
+        raise ArgumentTypeError(f"invalid size: {size}")
+
+class DownloadState:
+    """Append-only state file of the native engine in the output directory, so an
+    interrupted download continues where it stopped. One record per line:
+
+        F <json>                  file started: url, name, size, etag, last_modified
+        R <url> <start> <end>     bytes start..end-1 of the .part file are on disk
+        D <json>                  file complete: url, path, bytes
+
+    Range records are written every CHECKPOINT bytes of a range, after an fdatasync
+    of the .part file, so a recorded range is never lost to a crash. A torn last
+    line is ignored when loading.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.files = load_download_state(path) if os.path.exists(path) else {}
+        self.lock = threading.Lock()
+        self.fout = open(path, "a")
+
+    def write(self, line):
+        with self.lock:
+            self.fout.write(line + "\n")
+            self.fout.flush()
+            os.fsync(self.fout.fileno())
+
+    def write_file(self, info):
+        self.write("F " + json.dumps(info, separators=(",", ":")))
+
+    def write_range(self, url, start, end):
+        self.write(f"R {url} {start} {end}")
+
+    def write_complete(self, url, path, size):
+        self.write("D " + json.dumps({"url": url, "path": path, "bytes": size}, separators=(",", ":")))
+
+    def close(self):
+        if not self.fout.closed:
+            self.fout.close()
+
+def load_download_state(path):
+    """Reads a DownloadState back, returns a dict of url -> {"file": F record,
+    "ranges": [(start, end), ...] on disk, "complete": D record or None}"""
+    files = {}
+    with open(path) as fin:
+        for line in fin:
+            if not line.endswith("\n"):
+                # torn write at the end of the state file
+                break
+            kind, _, rest = line.rstrip("\n").partition(" ")
+            if kind == "F":
+                record = json.loads(rest)
+                files[record["url"]] = {"file": record, "ranges": [], "complete": None}
+            elif kind == "R":
+                url, start, end = rest.rsplit(" ", 2)
+                if url in files:
+                    files[url]["ranges"].append((int(start), int(end)))
+            elif kind == "D":
+                record = json.loads(rest)
+                if record["url"] in files:
+                    files[record["url"]]["complete"] = record
+    return files
+
+def missing_ranges(ranges, size):
+    """the (start, end) ranges of 0..size not covered by ranges"""
+    missing = []
+    offset = 0
+    for start, end in sorted(ranges):
+        if start > offset:
+            missing.append((offset, start))
+        offset = max(offset, end)
+    if offset < size:
+        missing.append((offset, size))
+    return missing
+
+def split_ranges(ranges, segments, min_segment):
+    """splits the largest of ranges in halves until there are segments of them or
+    the halves would be smaller than min_segment, keeping them in order"""
+    ranges = list(ranges)
+    while ranges and len(ranges) < segments:
+        i = max(range(len(ranges)), key=lambda k: ranges[k][1] - ranges[k][0])
+        start, end = ranges[i]
+        if (end - start) // 2 < min_segment:
+            break
+        middle = start + (end - start) // 2
+        ranges[i:i+1] = [(start, middle), (middle, end)]
+    return ranges
+
+def total_size(response):
+    """size of the whole file of a 200 or 206 response, None when unknown or when
+    the body is content-encoded"""
+    if "Content-Encoding" in response.headers:
+        return None
+    if response.status_code == 206:
+        total = response.headers.get("Content-Range", "").rpartition("/")[2]
+        return int(total) if total.isdigit() else None
+    length = response.headers.get("Content-Length")
+    return int(length) if length is not None else None
+
+def write_range(response, fd, start, end, stop, checkpoint=None):
+    """writes the body of response from offset start of fd with positional writes,
+    until end or until the stop event is set by a failed segment. With a checkpoint,
+    the written bytes are synced and passed to it as (start, end) every CHECKPOINT
+    bytes and when the range ends or fails. Returns the bytes written"""
+    offset = start
+    synced = start
+
+    def sync():
+        nonlocal synced
+        if checkpoint is not None and offset > synced:
+            os.fdatasync(fd)
+            checkpoint(synced, offset)
+            synced = offset
+
+    try:
+        for block in response.iter_content(DOWNLOAD_BLOCK):
+            if stop.is_set():
+                raise IOError("download aborted, another segment failed")
+            block = block[:end - offset]
+            os.pwrite(fd, block, offset)
+            progress.add(len(block))
+            offset += len(block)
+            if offset - synced >= CHECKPOINT:
+                sync()
+            if offset >= end:
+                break
+    finally:
+        sync()
+    if offset != end:
+        raise IOError(f"connection closed after {offset - start:,} of {end - start:,} bytes of range {start}-{end - 1}")
+    return end - start
+
+def fetch_range(url, fd, start, end, stop, checkpoint=None):
+    try:
+        headers = {"Range": f"bytes={start}-{end - 1}"}
+        with get_session().get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+            response.raise_for_status()
+            content_range = response.headers.get("Content-Range", "")
+            if response.status_code != 206 or not content_range.startswith(f"bytes {start}-"):
+                raise IOError(f"server did not honour {headers['Range']} (HTTP {response.status_code})")
+            return write_range(response, fd, start, end, stop, checkpoint)
+    except BaseException:
+        stop.set()
+        raise
+
+def download_ranges(url, response, fd, ranges, segments, checkpoint=None):
+    """Fetches ranges of the file of response into fd, up to segments of them at a
+    time: the first from response itself, which must start at its offset, the others
+    with Range requests from a thread each. Every range writes at its own offsets"""
+    stop = threading.Event()
+    workers = min(segments, len(ranges)) - 1
+    if workers < 1:
+        written = write_range(response, fd, *ranges[0], stop, checkpoint)
+        response.close()
+        return written + sum(fetch_range(url, fd, start, end, stop, checkpoint) for start, end in ranges[1:])
+    # the segment threads end with the file, their sessions are not reused
+    with ThreadPoolExecutor(workers) as executor:
+        futures = [executor.submit(fetch_range, url, fd, start, end, stop, checkpoint) for start, end in ranges[1:]]
+        try:
+            written = write_range(response, fd, *ranges[0], stop, checkpoint)
+        except BaseException:
+            stop.set()
+            raise
+        return written + sum(future.result() for future in futures)
+
+def resumable(previous, outdir):
+    """the ranges still missing of a file an earlier run left unfinished, None when there
+    is nothing to continue: no earlier run, no ranges on disk or a .part of the wrong size"""
+    if previous is None or previous["complete"] is not None or not previous["ranges"]:
+        return None
+    info = previous["file"]
+    part = os.path.join(outdir, info["name"]) + ".part"
+    if info["size"] is None or not os.path.isfile(part) or os.path.getsize(part) != info["size"]:
+        return None
+    return missing_ranges(previous["ranges"], info["size"]) or None
+
+def download_file(url, outdir=None, segments=SEGMENTS, min_segment=MIN_SEGMENT, state=None, resume=True):
+    """Downloads one url into outdir over the keep-alive session of this thread,
+    streamed to disk in large blocks and named after its Content-Disposition.
+    Large files are fetched in concurrent byte ranges when the server supports them.
+    With a DownloadState, files it records as complete are skipped and unfinished
+    ones continue from the ranges already on disk.
+    Returns a dict with url, path, bytes, resumed (bytes of an earlier run), skipped
+    (complete in an earlier run), seconds, segments, status (HTTP) and error (None on success)"""
+    outdir = outdir or OUTDIR
+    result = {"url": url, "path": None, "bytes": 0, "resumed": 0, "skipped": False, "seconds": 0.0, "segments": 1,
+              "status": None, "error": None}
+    start = time.perf_counter()
+    previous = state.files.get(url) if state is not None and resume else None
+    if previous is not None and previous["complete"] is not None:
+        done = previous["complete"]
+        if os.path.isfile(done["path"]) and os.path.getsize(done["path"]) == done["bytes"]:
+            result.update(path=done["path"], bytes=done["bytes"], resumed=done["bytes"], skipped=True)
+            progress.add_on_disk(done["bytes"])
+            return result
+    missing = resumable(previous, outdir)
+    part = None
+    fd = None
+    size = None
+    try:
+        headers = {"Range": f"bytes={missing[0][0]}-"} if missing else {}
+        with get_session().get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+            result["status"] = response.status_code
+            response.raise_for_status()
+            name = disposition_filename(response.headers.get("Content-Disposition")) or fallback_filename(url)
+            path = os.path.join(outdir, name)
+            part = path + ".part"
+            size = total_size(response)
+            info = {"url": url, "name": name, "size": size,
+                    "etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}
+            ranged = response.status_code == 206 or response.headers.get("Accept-Ranges", "").lower() == "bytes"
+            if response.status_code != 206:
+                # first run, or a server that no longer honours Range requests
+                missing = None
+            elif not missing:
+                raise IOError("unexpected partial content (HTTP 206) without a Range request")
+            elif info != previous["file"]:
+                # the file changed on the server since the earlier run, start it over
+                response.close()
+                os.unlink(os.path.join(outdir, previous["file"]["name"]) + ".part")
+                return download_file(url, outdir, segments, min_segment, state, resume=False)
+            if size is None:
+                # unknown length, a single stream that cannot be continued later
+                with open(part, "wb", buffering=DOWNLOAD_BUFFER) as fout:
+                    for block in response.iter_content(DOWNLOAD_BLOCK):
+                        fout.write(block)
+                        result["bytes"] += len(block)
+                        progress.add(len(block))
+            else:
+                checkpoint = None
+                if state is not None:
+                    checkpoint = lambda s, e: state.write_range(url, s, e)
+                if missing:
+                    fd = os.open(part, os.O_WRONLY)
+                    result["resumed"] = size - sum(end - begin for begin, end in missing)
+                    progress.add_on_disk(result["resumed"])
+                else:
+                    if state is not None:
+                        # drops the ranges of an earlier download before its .part is
+                        # truncated, a crash in between must not leave them standing
+                        state.write_file(info)
+                    fd = os.open(part, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+                    os.ftruncate(fd, size)
+                    try:
+                        # reserves the space, ENOSPC now rather than after hours of downloading
+                        os.posix_fallocate(fd, 0, size)
+                    except (AttributeError, OSError):
+                        pass
+                    missing = [(0, size)] if size else []
+                ranges = split_ranges(missing, segments if ranged else 1, min_segment)
+                result["segments"] = max(1, len(ranges))
+                if ranges:
+                    download_ranges(url, response, fd, ranges, segments if ranged else 1, checkpoint)
+                os.fsync(fd)
+                result["bytes"] = size
+        if fd is not None:
+            os.close(fd)
+            fd = None
+        os.replace(part, path)
+        if state is not None and size is not None:
+            state.write_complete(url, path, size)
+        part = None
+        result["path"] = path
+    except (requests.exceptions.RequestException, OSError, ValueError) as e:
+        result["error"] = str(e)
+        # a .part with ranges in the state file is continued by the next run
+        if part is not None and os.path.exists(part) and (state is None or size is None):
+            os.unlink(part)
+    finally:
+        if fd is not None:
+            os.close(fd)
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+class Progress:
+    """bytes received by all download threads, and bytes found on disk from an earlier run"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.received = 0
+        self.on_disk = 0
+
+    def add(self, n):
+        with self.lock:
+            self.received += n
+
+    def add_on_disk(self, n):
+        with self.lock:
+            self.on_disk += n
+
+progress = Progress()
+
+def largest_first(sizes):
+    """indices of sizes from the largest to the smallest, unknown sizes last in page order"""
+    return sorted(range(len(sizes)), key=lambda i: (sizes[i] is None, -(sizes[i] or 0)))
+
+def report_progress(total, stop, first=5, interval=30):
+    """prints the bytes done of total, the rate and the ETA after first seconds and then every
+    interval seconds, until stop is set"""
+    start = time.perf_counter()
+    received = progress.received
+    wait = first
+    while not stop.wait(wait):
+        wait = interval
+        done = progress.received - received
+        rate = done / (time.perf_counter() - start)
+        complete = done + progress.on_disk
+        eta = f"{datetime.timedelta(seconds=round((total - complete) / rate))}" if rate else "unknown"
+        print(f"progress: {complete:,} of {total:,} bytes ({complete / total * 100 if total else 100:.0f}%), "
+              f"{rate / 1024**2:.1f} MB/s, ETA {eta}", flush=True)
+
+def download_files(urls, outdir=None, parallel=8, segments=SEGMENTS, min_segment=MIN_SEGMENT, state=None, sizes=None):
+    """Downloads urls with parallel threads, printing a line per finished file. With the
+    sizes of the files they are started largest first, so that the largest does not start
+    last and stretch the total time, and an ETA is printed every now and then.
+    Returns the download_file results in the order of urls"""
+    results = [None] * len(urls)
+    order = range(len(urls))
+    stop = threading.Event()
+    if sizes and all(size is not None for size in sizes):
+        order = largest_first(sizes)
+        total = sum(sizes)
+        print(f"{len(urls)} files, {total:,} bytes, largest first ({sizes[order[0]]:,} bytes)", flush=True)
+        threading.Thread(target=report_progress, args=(total, stop), daemon=True).start()
+    elif sizes:
+        order = largest_first(sizes)
+    # the executor hands each file to the next idle thread, so threads that finish small
+    # files early take on the remaining ones
+    with ThreadPoolExecutor(max(1, parallel)) as executor:
+        futures = {executor.submit(download_file, urls[i], outdir, segments, min_segment, state): i for i in order}
+        for future in as_completed(futures):
+            r = results[futures[future]] = future.result()
+            if r["skipped"]:
+                print(f"skipped {r['path']}, complete in an earlier run", flush=True)
+            elif r["error"] is None:
+                rate = (r["bytes"] - r["resumed"]) / r["seconds"] / 1024**2 if r["seconds"] else 0
+                segmented = f" in {r['segments']} segments" if r["segments"] > 1 else ""
+                resumed = f", {r['resumed']:,} from an earlier run" if r["resumed"] else ""
+                print(f"done {r['path']} {r['bytes']:,} bytes{resumed}{segmented} {r['seconds']:.1f} s {rate:.1f} MB/s",
+                      flush=True)
+            else:
+                print(f"FAILED {r['url']}: {r['error']}", flush=True)
+    stop.set()
+    return results
+
+def summarise(results, seconds):
+    ok = [r for r in results if r["error"] is None]
+    size = sum(r["bytes"] - r["resumed"] for r in ok)
+    resumed = sum(r["resumed"] for r in results)
+    print(f"{len(ok)} of {len(results)} files downloaded, {size:,} bytes in {seconds:.1f} s "
+          f"({size / seconds / 1024**2 if seconds else 0:.1f} MB/s)"
+          + (f", {resumed:,} bytes were already on disk" if resumed else ""))
+    for r in results:
+        if r["error"] is not None:
+            print(f"  failed: {r['url']} ({r['error']})")
+
+ZIP_LOCAL = b"PK\x03\x04"
+ZIP_DESCRIPTOR = b"PK\x07\x08"
+
+class CountingReader:
+    """file-like reads from a response body, counting the bytes"""
+    def __init__(self, raw):
+        self.raw = raw
+        self.count = 0
+
+    def read(self, n=-1):
+        data = self.raw.read(n)
+        self.count += len(data)
+        return data
+
+class PushbackReader:
+    """reads of exact lengths from a stream, with data read too far pushed back"""
+    def __init__(self, fin):
+        self.fin = fin
+        self.buffer = b""
+
+    def read(self, n):
+        if self.buffer:
+            data, self.buffer = self.buffer[:n], self.buffer[n:]
+            return data
+        return self.fin.read(n)
+
+    def read_exact(self, n):
+        data = b""
+        while len(data) < n:
+            block = self.read(n - len(data))
+            if not block:
+                raise IOError("archive ends early")
+            data += block
+        return data
+
+    def unread(self, data):
+        self.buffer = data + self.buffer
+
+    def peek(self, n):
+        data = self.read(n)
+        while data and len(data) < n:
+            block = self.read(n - len(data))
+            if not block:
+                break
+            data += block
+        self.unread(data)
+        return data
+
+def member_path(outdir, name):
+    """path of an archive member below outdir, IOError for absolute names or names with .."""
+    parts = [p for p in name.replace("\\", "/").split("/") if p not in ("", ".")]
+    if not parts or ".." in parts or os.path.isabs(name) or ":" in parts[0]:
+        raise IOError(f"unsafe member name in archive: {name!r}")
+    return os.path.join(outdir, *parts)
+
+def extract_tar_stream(fin, outdir):
+    """extracts a tar stream member by member while it is read, returns the number of members"""
+    members = 0
+    with tarfile.open(fileobj=fin, mode="r|*", bufsize=DOWNLOAD_BLOCK) as tf:
+        for member in tf:
+            if hasattr(tarfile, "data_filter"):
+                tf.extract(member, outdir, filter="data")
+            elif member.isdir() or member.isfile():
+                member_path(outdir, member.name)
+                tf.extract(member, outdir)
+            else:
+                continue
+            members += 1
+    return members
+
+def zip_sizes(extra, csize, usize):
+    """sizes from the zip64 extra field of a local header, and whether it has one"""
+    offset = 0
+    while offset + 4 <= len(extra):
+        tag, length = struct.unpack_from("<HH", extra, offset)
+        if tag == 0x0001:
+            values = extra[offset + 4:offset + 4 + length]
+            fields = []
+            if usize == 0xFFFFFFFF:
+                fields.append("usize")
+            if csize == 0xFFFFFFFF:
+                fields.append("csize")
+            found = dict(zip(fields, struct.unpack_from(f"<{len(fields)}Q", values))) if fields else {}
+            return found.get("csize", csize), found.get("usize", usize), True
+        offset += 4 + length
+    return csize, usize, False
+
+def extract_zip_stream(fin, outdir):
+    """Extracts a zip stream from its local headers while it is read, returns the number
+    of members. Members stored (not deflated) with their sizes only in a trailing data
+    descriptor, encrypted members and other compression methods cannot be read this way:
+    from the first of them on, the rest of the archive is spooled to a temporary file in
+    outdir and extracted with zipfile"""
+    reader = PushbackReader(fin)
+    members = 0
+    while reader.peek(4) == ZIP_LOCAL:
+        header = reader.read_exact(30)
+        (_, _, flags, method, _, _, crc, csize, usize, name_len, extra_len) = struct.unpack("<4sHHHHHIIIHH", header)
+        raw_name = reader.read_exact(name_len)
+        extra = reader.read_exact(extra_len)
+        name = raw_name.decode("utf-8" if flags & 0x800 else "cp437")
+        csize, usize, zip64 = zip_sizes(extra, csize, usize)
+        descriptor = flags & 0x08
+        if flags & 0x01 or method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED) or \
+                (method == zipfile.ZIP_STORED and descriptor and csize == 0):
+            reader.unread(header + raw_name + extra)
+            return members + extract_zip_spooled(reader, outdir)
+        path = member_path(outdir, name)
+        if name.endswith("/"):
+            os.makedirs(path, exist_ok=True)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb", buffering=DOWNLOAD_BUFFER) as fout:
+                written, crc_data = 0, 0
+                if method == zipfile.ZIP_DEFLATED:
+                    inflate = zlib.decompressobj(-15)
+                    while not inflate.eof:
+                        block = reader.read(DOWNLOAD_BLOCK)
+                        if not block:
+                            raise IOError(f"archive ends inside {name}")
+                        # bounded output per call, a small block can inflate to a lot
+                        while block and not inflate.eof:
+                            data = inflate.decompress(block, DOWNLOAD_BLOCK)
+                            fout.write(data)
+                            written += len(data)
+                            crc_data = zlib.crc32(data, crc_data)
+                            block = inflate.unconsumed_tail
+                        reader.unread(inflate.unused_data)
+                else:
+                    left = csize
+                    while left:
+                        data = reader.read(min(left, DOWNLOAD_BLOCK))
+                        if not data:
+                            raise IOError(f"archive ends inside {name}")
+                        fout.write(data)
+                        left -= len(data)
+                        written += len(data)
+                        crc_data = zlib.crc32(data, crc_data)
+            if descriptor:
+                if reader.peek(4) == ZIP_DESCRIPTOR:
+                    reader.read_exact(4)
+                crc, _, usize = struct.unpack("<IQQ" if zip64 else "<III", reader.read_exact(20 if zip64 else 12))
+            if crc_data != crc or written != usize:
+                raise IOError(f"{name} is corrupt: crc or size do not match the archive")
+        members += 1
+    return members
+
+def extract_zip_spooled(reader, outdir):
+    """writes the rest of a zip stream to a temporary file and extracts its members with
+    zipfile; members extracted from the stream before lie outside of the spooled part"""
+    with tempfile.TemporaryFile(dir=outdir) as spool:
+        while True:
+            block = reader.read(DOWNLOAD_BLOCK)
+            if not block:
+                break
+            spool.write(block)
+        spool.seek(0)
+        members = 0
+        with zipfile.ZipFile(spool) as zf:
+            for info in zf.infolist():
+                # zipfile shifts the offsets by the bytes missing at the start
+                if info.header_offset < 0:
+                    continue
+                member_path(outdir, info.filename)
+                zf.extract(info, outdir)
+                members += 1
+    return members
+
+def extract_archive(url, outdir=None, archive_format="tar"):
+    """Downloads the single archive of url and extracts it into outdir while it arrives,
+    without writing the archive itself. Returns a dict like download_file, with path
+    outdir, bytes of the archive and members extracted"""
+    outdir = outdir or OUTDIR
+    result = {"url": url, "path": outdir, "bytes": 0, "resumed": 0, "skipped": False, "seconds": 0.0, "segments": 1,
+              "members": 0, "status": None, "error": None}
+    start = time.perf_counter()
+    try:
+        with get_session().get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+            result["status"] = response.status_code
+            response.raise_for_status()
+            response.raw.decode_content = True
+            fin = CountingReader(response.raw)
+            try:
+                if archive_format == "tar":
+                    result["members"] = extract_tar_stream(fin, outdir)
+                else:
+                    result["members"] = extract_zip_stream(fin, outdir)
+            finally:
+                result["bytes"] = fin.count
+    except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError, OSError, ValueError,
+            tarfile.TarError, zipfile.BadZipFile, zlib.error) as e:
+        result["error"] = str(e)
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+def download_base(url):
+    """download.php of the FileSender instance serving the download page url"""
+    parts = urlsplit(url)
+    if not parts.netloc:
+        return "https://filesender.aarnet.edu.au/download.php"
+    return f"{parts.scheme}://{parts.netloc}{parts.path.rsplit('/', 1)[0]}/download.php"
+
 class FileSenderDownload:
     def __init__(self, url, archive_format=None):
         self.archive_format = archive_format
@@ -99,13 +754,17 @@ class FileSenderDownload:
 #        self.directlinks = [x.split("Direct Link: ")[1].strip() for x in self.directlinks]
 #        self.fileids = [x.split("&files_ids=")[1] for x in self.directlinks]
         self.fileids = parser.extract_tr_by_attr(self.html_content)
-        baseurl = "https://filesender.aarnet.edu.au/download.php"
+        # name and size of every file id, sizes are None if the page does not give them
+        self.files = parser.files
+        self.sizes = [f["size"] for f in self.files]
+        self.baseurl = download_base(url)
+        baseurl = self.baseurl
         print(self.fileids)
         self.directlinks = [ f"{baseurl}?token={self.token}&files_ids={x}" for x in self.fileids ]
         print(self.directlinks)
 
     def single_archive_link(self):
-        base_url = "https://filesender.aarnet.edu.au/download.php?"
+        base_url = f"{self.baseurl}?"
         base_url += f"token={self.token}&files_ids={'%2C'.join(self.fileids)}&archive_format={self.archive_format}"
         return base_url
 
@@ -113,8 +772,37 @@ if __name__=="__main__":
     args = handle_args()
     OUTDIR=args.outdir
 
+    if args.extract and (not args.single or args.engine != "native"):
+        sys.exit("--extract needs --single tar|zip and the native engine")
+
     fsdownload=FileSenderDownload(args.url, archive_format=args.single)
-    if args.single:
+    if args.engine == "native":
+        if args.parallel < 1:
+            raise ValueError("--parallel value must be positive integer")
+        os.makedirs(OUTDIR, exist_ok=True)
+        # the streamed extraction cannot be continued, it keeps no state
+        state = None if args.extract else DownloadState(os.path.join(OUTDIR, STATE_FILE))
+        start = time.perf_counter()
+        if args.single and args.extract:
+            print(f"extracting a single {args.single} file into {OUTDIR}")
+            results = [extract_archive(fsdownload.single_archive_link(), OUTDIR, args.single)]
+            print(f"{results[0]['members']} archive members extracted")
+        elif args.single:
+            print(f"downloading a single {args.single} file")
+            results = [download_file(fsdownload.single_archive_link(), OUTDIR, args.segments, args.min_segment_size,
+                                     state)]
+        else:
+            print(f"download {args.parallel} files in parallel")
+            results = download_files(fsdownload.directlinks, OUTDIR, args.parallel, args.segments, args.min_segment_size,
+                                     state, fsdownload.sizes)
+        if state is not None:
+            state.close()
+        summarise(results, time.perf_counter() - start)
+        if args.results:
+            with open(args.results, "w") as fout:
+                json.dump(results, fout, indent=2)
+        sys.exit(0 if all(r["error"] is None for r in results) else 1)
+    elif args.single:
         print(f"downloading a single {args.single} file")
         download_url(fsdownload.single_archive_link())
         exit()
@@ -126,8 +814,11 @@ if __name__=="__main__":
             for url_ in fsdownload.directlinks:
                 download_url(url_)
         else:
+            # largest first, one url at a time to whichever process is idle
+            order = largest_first(fsdownload.sizes)
             pool = Pool(args.parallel)
-            pool.map(download_url, fsdownload.directlinks)
+            for _ in pool.imap_unordered(download_url, [fsdownload.directlinks[i] for i in order], chunksize=1):
+                pass
         
 
 
@@ -29,31 +29,103 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import argparse
-try:
-    import requests
-    import time
-    from collections.abc import Iterable
-    from collections.abc import MutableMapping
-    import hmac
-    import hashlib
-    import urllib3
-    import os
-    import json
-    import configparser
-    from os.path import expanduser
-    from multiprocessing import Pool
-    from functools import partial
-    from string import Template
-except Exception as e:
-    print(type(e))
-    print(e.args)
-    print(e)
-    print('')
-    print('ERROR: A required dependency is not installed, please check your')
-    print('distribution packages or run something like the following')
-    print('')
-    print('pip3 install requests urllib3 ')
-    exit(1)
+import time
+from collections.abc import Iterable
+from collections.abc import MutableMapping
+import hmac
+import hashlib
+import os
+import sys
+import json
+import configparser
+import atexit
+import random
+import queue
+from multiprocessing import Value, Lock
+import threading
+from datetime import datetime
+from collections import deque
+import shutil
+from os.path import expanduser
+from multiprocessing import Pool
+from string import Template
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+import tarfile
+import bisect
+import io
+import tempfile
+import sqlite3
+import secrets
+import getpass
+
+# imported on first use by the load_* functions below, they take a while to import
+# and aiohttp, zstandard and cryptography are optional
+requests = None
+urllib3 = None
+asyncio = None
+aiohttp = None
+zstandard = None
+ciphers = None
+
+
+class UploadError(Exception):
+    """An upload that can't go ahead, the message is meant for the user
+    """
+
+
+def load_requests():
+    global requests, urllib3
+    if requests is None:
+        try:
+            import requests
+            import urllib3
+        except ImportError as e:
+            raise UploadError(f'{e}, a required dependency is not installed, please check your distribution '
+                              'packages or run something like the following\n\npip3 install requests urllib3')
+        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    return requests
+
+
+def load_aiohttp():
+    """only needed for --engine async
+    """
+    global asyncio, aiohttp
+    if aiohttp is None:
+        try:
+            import asyncio
+            import aiohttp
+        except ImportError:
+            raise UploadError('--engine async needs aiohttp, run something like the following\n\npip3 install aiohttp')
+    return aiohttp
+
+
+def load_zstandard():
+    """only needed for --compress zstd
+    """
+    global zstandard
+    if zstandard is None:
+        try:
+            import zstandard
+        except ImportError:
+            raise UploadError('--compress zstd needs zstandard, run something like the following\n\n'
+                              'pip3 install zstandard')
+    return zstandard
+
+
+def load_cryptography():
+    """only needed for --encrypt
+    """
+    global ciphers
+    if ciphers is None:
+        try:
+            from cryptography.hazmat.primitives import ciphers
+            import cryptography.hazmat.primitives.ciphers.algorithms
+            import cryptography.hazmat.primitives.ciphers.modes
+        except ImportError:
+            raise UploadError('--encrypt needs cryptography, run something like the following\n\n'
+                              'pip3 install cryptography')
+    return ciphers
 
 ##########################################################################
 
@@ -68,7 +140,73 @@ def flatten(d, parent_key=''):
     items.sort()
     return items
 
-def call(method, path, data, content=None, rawContent=None, options={}):
+# connections kept alive per process, each worker only has one request in flight
+HTTP_POOL_MAXSIZE = 4
+
+_session = None
+_session_pid = None
+
+
+def get_session():
+    """Returns the long-lived requests.Session of this process, so every REST call
+    reuses the same keep-alive connections instead of a new TCP/TLS handshake.
+    Workers forked from the main process get their own session on first use.
+    """
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        load_requests()
+        _session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_MAXSIZE)
+        _session.mount('https://', adapter)
+        _session.mount('http://', adapter)
+        _session.headers['Connection'] = 'keep-alive'
+        _session_pid = os.getpid()
+    return _session
+
+
+def connection_stats():
+    """Number of connections opened (= TCP/TLS handshakes) and requests sent by this
+    process's session, requests - connections is the number of reused connections
+    """
+    stats = {'connections': 0, 'requests': 0}
+    if _session is None or _session_pid != os.getpid():
+        return stats
+    # the same adapter is mounted for http:// and https://
+    for adapter in set(_session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            stats['connections'] += pool.num_connections
+            stats['requests'] += pool.num_requests
+    return stats
+
+
+def merge_connection_stats(stats_list):
+    total = {'connections': 0, 'requests': 0}
+    for stats in stats_list:
+        total['connections'] += stats['connections']
+        total['requests'] += stats['requests']
+    total['reused'] = total['requests'] - total['connections']
+    return total
+
+
+class HttpError(Exception):
+    """Error response from the FileSender REST API, keeps the http status code
+    """
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.code = code
+
+    def __reduce__(self):
+        # so it survives being sent back from a Pool worker
+        return (HttpError, (str(self), self.code))
+
+
+def sign_request(method, path, data, content=None, rawContent=None, options={}):
+    """Signs a REST request, returns the url, the body and the headers to send.
+    rawContent can be any bytes-like object, e.g. a memoryview of a chunk buffer,
+    it is fed to the HMAC as is and passed on to the http layer without a copy.
+    """
     data['remote_user'] = username
     data['timestamp'] = str(round(time.time()))
     flatdata = flatten(data)
@@ -76,39 +214,47 @@ def call(method, path, data, content=None, rawContent=None, options={}):
                    1).replace('http://', '', 1)+path+'?'+('&'.join(flatten(data))), 'ascii')
     content_type = options['Content-Type'] if 'Content-Type' in options else 'application/json'
 
+    bkey = bytearray()
+    bkey.extend(map(ord, apikey))
+    signature = hmac.new(bkey, signed, hashlib.sha1)
+
     inputcontent = None
     if content is not None and content_type == 'application/json':
         inputcontent = json.dumps(content, separators=(',', ':'))
-        signed += bytes('&'+inputcontent, 'ascii')
+        signature.update(bytes('&'+inputcontent, 'ascii'))
     elif rawContent is not None:
         inputcontent = rawContent
-        signed += bytes('&', 'ascii')
-        signed += inputcontent
+        signature.update(b'&')
+        signature.update(inputcontent)
 
-    # print(signed)
-    bkey = bytearray()
-    bkey.extend(map(ord, apikey))
-    data['signature'] = hmac.new(bkey, signed, hashlib.sha1).hexdigest()
+    data['signature'] = signature.hexdigest()
 
     url = base_url+path+'?'+('&'.join(flatten(data)))
     headers = {
         "Accept": "application/json",
         "Content-Type": content_type
     }
+    headers.update({k: v for k, v in options.items() if k != 'Content-Type'})
+    return url, inputcontent, headers
+
+
+def call(method, path, data, content=None, rawContent=None, options={}):
+    url, inputcontent, headers = sign_request(method, path, data, content, rawContent, options)
+    session = get_session()
     response = None
     if method == "get":
-        response = requests.get(url, verify=not insecure, headers=headers)
+        response = session.get(url, verify=not insecure, headers=headers)
     elif method == "post":
-        response = requests.post(
+        response = session.post(
             url, data=inputcontent, verify=not insecure, headers=headers)
     elif method == "put":
-        response = requests.put(url, data=inputcontent,
-                                verify=not insecure, headers=headers)
+        response = session.put(url, data=inputcontent,
+                               verify=not insecure, headers=headers)
     elif method == "delete":
-        response = requests.delete(url, verify=not insecure, headers=headers)
+        response = session.delete(url, verify=not insecure, headers=headers)
 
     if response is None:
-        raise Exception('Client error')
+        raise HttpError('Client error')
 
     code = response.status_code
     # print(url)
@@ -118,10 +264,10 @@ def call(method, path, data, content=None, rawContent=None, options={}):
 
     if code != 200:
         if method != 'post' or code != 201:
-            raise Exception('Http error '+str(code)+' '+response.text)
+            raise HttpError('Http error '+str(code)+' '+response.text, code)
 
     if response.text == "":
-        raise Exception('Http error '+str(code)+' Empty response')
+        raise HttpError('Http error '+str(code)+' Empty response', code)
 
     if method != 'post':
         return response.json()
@@ -132,31 +278,40 @@ def call(method, path, data, content=None, rawContent=None, options={}):
     return r
 
 
-def postTransfer(user_id, files, recipients, subject=None, message=None, expires=None, options=[]):
+def postTransfer(user_id, files, recipients, subject=None, message=None, expires=None, options=[], encryption=None):
     if expires is None:
         expires = round(time.time()) + (default_transfer_days_valid*24*3600)
 
     print(expires)
     to = [x.strip() for x in recipients.split(',')]
+    content = {
+        'from': user_id,
+        'files': files,
+        'recipients': to,
+        'subject': subject,
+        'message': message,
+        'expires': expires,
+        'aup_checked': 1,
+        'options': options
+    }
+    if encryption is not None:
+        content.update(encryption)
     return call(
         'post',
         '/transfer',
         {},
-        {
-            'from': user_id,
-            'files': files,
-            'recipients': to,
-            'subject': subject,
-            'message': message,
-            'expires': expires,
-            'aup_checked': 1,
-            'options': options
-        },
+        content,
         None,
         {}
     )
 
 
+def chunk_headers():
+    if encryption_key is not None:
+        return {'Content-Type': 'application/octet-stream', 'X-Filesender-Encrypted': '1'}
+    return {'Content-Type': 'application/octet-stream'}
+
+
 def putChunk(t, f, chunk, offset):
     return call(
         'put',
@@ -164,7 +319,7 @@ def putChunk(t, f, chunk, offset):
         {'key': f['uid'], 'roundtriptoken': t['roundtriptoken']},
         None,
         chunk,
-        {'Content-Type': 'application/octet-stream'}
+        chunk_headers()
     )
 
 
@@ -190,6 +345,61 @@ def transferComplete(transfer):
     )
 
 
+async def callAsync(session, method, path, data, content=None, rawContent=None, options={}):
+    """Same as call() for the async engine, sent through an aiohttp.ClientSession
+    """
+    url, inputcontent, headers = sign_request(method, path, data, content, rawContent, options)
+    async with session.request(method.upper(), url, data=inputcontent, headers=headers,
+                               ssl=False if insecure else None) as response:
+        code = response.status
+        text = await response.text()
+
+    if code != 200:
+        if method != 'post' or code != 201:
+            raise HttpError('Http error '+str(code)+' '+text, code)
+
+    if text == "":
+        raise HttpError('Http error '+str(code)+' Empty response', code)
+
+    return json.loads(text)
+
+
+async def putChunkAsync(session, t, f, chunk, offset):
+    return await callAsync(
+        session,
+        'put',
+        '/file/'+str(f['id'])+'/chunk/'+str(offset),
+        {'key': f['uid'], 'roundtriptoken': t['roundtriptoken']},
+        None,
+        chunk,
+        chunk_headers()
+    )
+
+
+async def fileCompleteAsync(session, t, f):
+    return await callAsync(
+        session,
+        'put',
+        '/file/'+str(f['id']),
+        {'key': f['uid'], 'roundtriptoken': t['roundtriptoken']},
+        {'complete': True},
+        None,
+        {}
+    )
+
+
+async def transferCompleteAsync(session, transfer):
+    return await callAsync(
+        session,
+        'put',
+        '/transfer/'+str(transfer['id']),
+        {'key': transfer['files'][0]['uid']},
+        {'complete': True},
+        None,
+        {}
+    )
+
+
 def deleteTransfer(transfer):
     return call(
         'delete',
@@ -202,41 +412,1638 @@ def deleteTransfer(transfer):
 
 ##########################################################################
 
-def upload_file( fileobject, transferData, filesData, upload_chunk_size, debug):
-    """This is the mp worker that replaces the last "try" block in the original script
+class ChunkJournal:
+    """Append-only journal of a transfer, so an interrupted upload can be resumed
+    with --resume instead of starting over. One record per line:
+
+        T <json>            transfer posted: set index, id, roundtriptoken, files
+        C <file id> <offset> chunk acknowledged by the server
+        F <file id>         fileComplete acknowledged
+        D <json>            transferComplete response
+
+    Chunk records are only fsync'ed every sync_every records or sync_interval
+    seconds, a crash loses at most that many acknowledgements, which are then
+    simply sent again. A torn last line is ignored when loading. Records may come
+    from two threads (the async engine posts transfers from a thread).
+    """
+    def __init__(self, path, sync_every=256, sync_interval=1.0):
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.fout = open(path, "a")
+        self.unsynced = 0
+        self.last_sync = time.time()
+        self.lock = threading.Lock()
+
+    def sync(self):
+        self.fout.flush()
+        os.fsync(self.fout.fileno())
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+    def write_transfer(self, set_index, transfer):
+        record = {
+            'set': set_index,
+            'id': transfer['id'],
+            'roundtriptoken': transfer['roundtriptoken'],
+            'files': [{'id': f['id'], 'uid': f['uid'], 'name': f['name'], 'size': f['size']}
+                      for f in transfer['files']]
+        }
+        if 'encryption_details' in transfer:
+            # salt and iterations, the same key is needed to resume
+            record['encryption_details'] = transfer['encryption_details']
+        with self.lock:
+            self.fout.write('T '+json.dumps(record, separators=(',', ':'))+'\n')
+            self.sync()
+
+    def write_chunk(self, file_id, offset):
+        with self.lock:
+            self.fout.write(f"C {file_id} {offset}\n")
+            self.unsynced += 1
+            if self.unsynced >= self.sync_every or time.time() - self.last_sync >= self.sync_interval:
+                self.sync()
+
+    def write_file_complete(self, file_id):
+        with self.lock:
+            self.fout.write(f"F {file_id}\n")
+            self.unsynced += 1
+
+    def write_transfer_complete(self, set_index, response):
+        with self.lock:
+            self.fout.write('D '+json.dumps({'set': set_index, 'response': response}, separators=(',', ':'))+'\n')
+            self.sync()
+
+    def close(self):
+        with self.lock:
+            if not self.fout.closed:
+                self.sync()
+                self.fout.close()
+
+
+def load_journal(path):
+    """Reads a ChunkJournal back, returns a dict of set index -> state with the
+    transfer, the acknowledged chunk offsets per file id, the completed file ids
+    and the transferComplete response if the set was finished
+    """
+    sets = {}
+    file_set = {}
+    with open(path) as fin:
+        for line in fin:
+            if not line.endswith('\n'):
+                # torn write at the end of the journal
+                break
+            kind, _, rest = line.rstrip('\n').partition(' ')
+            if kind == 'T':
+                record = json.loads(rest)
+                sets[record['set']] = {'transfer': record, 'acked': {}, 'completed': set(), 'response': None}
+                for f in record['files']:
+                    file_set[f['id']] = record['set']
+                    sets[record['set']]['acked'][f['id']] = set()
+            elif kind == 'C':
+                file_id, offset = rest.split(' ')
+                sets[file_set[int(file_id)]]['acked'][int(file_id)].add(int(offset))
+            elif kind == 'F':
+                sets[file_set[int(rest)]]['completed'].add(int(rest))
+            elif kind == 'D':
+                record = json.loads(rest)
+                sets[record['set']]['response'] = record['response']
+    return sets
+
+
+class ProgressAggregator:
+    """Collects the chunk completions of all workers in the main process, from the
+    results the engines get back anyway, so it adds no per-chunk IPC. A background
+    thread renders one compact status line (with --progress) and refreshes the
+    metrics files (with --metrics): PREFIX.prom in Prometheus textfile format and
+    PREFIX.json.
+    """
+    def __init__(self, total_bytes, total_files, show=True, metrics=None, metrics_interval=10):
+        self.total_bytes = total_bytes
+        self.total_files = total_files
+        self.show = show
+        self.metrics = metrics
+        self.metrics_interval = metrics_interval
+        self.tty = sys.stdout.isatty()
+        # one line per 30s in logs, a refreshed line on a terminal
+        self.interval = 1 if self.tty else 30
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.last_progress = self.start_time
+        self.bytes_done = 0
+        self.bytes_sent = 0
+        self.chunks_sent = 0
+        self.retries = 0
+        self.files_done = 0
+        self.active = 0
+        # file id -> [name, size, bytes done] of the files being uploaded
+        self.files = {}
+        # (time, bytes sent) over the last RATE_WINDOW seconds for the current rate
+        self.samples = deque([(self.start_time, 0)])
+        self.stopped = threading.Event()
+        self.thread = None
+
+    RATE_WINDOW = 20
+
+    def add_file(self, fileobject, bytes_done=0):
+        with self.lock:
+            self.files[fileobject['id']] = [fileobject['name'], fileobject['size'], bytes_done]
+            self.bytes_done += bytes_done
+
+    def add_total(self, nbytes):
+        """changes the total, e.g. by the bytes saved by compression
+        """
+        with self.lock:
+            self.total_bytes += nbytes
+
+    def add_done(self, nbytes, nfiles=0):
+        """bytes and files already on the server, e.g. from a resumed journal
+        """
+        with self.lock:
+            self.bytes_done += nbytes
+            self.files_done += nfiles
+
+    def chunk_done(self, file_id, nbytes, retries=0):
+        with self.lock:
+            self.files[file_id][2] += nbytes
+            self.bytes_done += nbytes
+            self.bytes_sent += nbytes
+            self.chunks_sent += 1
+            self.retries += retries
+            self.last_progress = time.time()
+
+    def file_done(self, file_id):
+        with self.lock:
+            self.files.pop(file_id, None)
+            self.files_done += 1
+
+    def set_active(self, active):
+        self.active = active
+
+    def snapshot(self):
+        with self.lock:
+            now = time.time()
+            self.samples.append((now, self.bytes_sent))
+            while len(self.samples) > 2 and now - self.samples[1][0] > self.RATE_WINDOW:
+                self.samples.popleft()
+            t0, b0 = self.samples[0]
+            rate = (self.bytes_sent - b0) / (now - t0) if now > t0 else 0
+            remaining = self.total_bytes - self.bytes_done
+            return {
+                'timestamp': now,
+                'elapsed_seconds': now - self.start_time,
+                'bytes_total': self.total_bytes,
+                'bytes_done': self.bytes_done,
+                'bytes_sent': self.bytes_sent,
+                'rate_bytes_per_second': rate,
+                'eta_seconds': remaining / rate if rate > 0 else None,
+                'files_total': self.total_files,
+                'files_done': self.files_done,
+                'chunks_sent': self.chunks_sent,
+                'retries': self.retries,
+                'active_workers': self.active,
+                'last_progress_timestamp': self.last_progress,
+                'files_in_progress': sorted(([name, size, done] for name, size, done in self.files.values() if done),
+                                            key=lambda x: x[1], reverse=True)
+            }
+
+    def status_line(self, snap):
+        pct = snap['bytes_done'] / snap['bytes_total'] * 100 if snap['bytes_total'] else 100
+        eta = snap['eta_seconds']
+        eta_str = time.strftime('%H:%M:%S', time.gmtime(eta)) if eta is not None else '--:--:--'
+        line = (f"{snap['bytes_done']/1024**3:.2f}/{snap['bytes_total']/1024**3:.2f} GB {pct:5.1f}% "
+                f"{snap['rate_bytes_per_second']/1024**2:7.1f} MB/s ETA {eta_str} "
+                f"workers {snap['active_workers']} files {snap['files_done']}/{snap['files_total']}")
+        for name, size, done in snap['files_in_progress'][:3]:
+            line += f" | {name} {done/size*100:.0f}%"
+        return line
+
+    def render(self, snap, final=False):
+        line = self.status_line(snap)
+        if self.tty:
+            width = shutil.get_terminal_size().columns - 1
+            print('\r' + line[:width].ljust(width), end='\n' if final else '', flush=True)
+        else:
+            print(line, flush=True)
+
+    def write_metrics(self, snap):
+        prom = [
+            ('bytes_total', 'gauge', 'Total bytes of the upload', snap['bytes_total']),
+            ('bytes_done', 'gauge', 'Bytes on the server, including resumed chunks', snap['bytes_done']),
+            ('bytes_sent_total', 'counter', 'Bytes sent by this run', snap['bytes_sent']),
+            ('rate_bytes_per_second', 'gauge', 'Upload rate over the last seconds', snap['rate_bytes_per_second']),
+            ('eta_seconds', 'gauge', 'Estimated seconds to completion, -1 if unknown',
+             snap['eta_seconds'] if snap['eta_seconds'] is not None else -1),
+            ('files_total', 'gauge', 'Number of files of the upload', snap['files_total']),
+            ('files_done', 'gauge', 'Number of files complete', snap['files_done']),
+            ('chunks_sent_total', 'counter', 'Chunks sent by this run', snap['chunks_sent']),
+            ('retries_total', 'counter', 'Chunk retries', snap['retries']),
+            ('active_workers', 'gauge', 'Chunks in flight', snap['active_workers']),
+            ('last_progress_timestamp_seconds', 'gauge', 'Time of the last acknowledged chunk',
+             snap['last_progress_timestamp']),
+        ]
+        text = ''
+        for name, kind, help_text, value in prom:
+            text += f"# HELP filesender_upload_{name} {help_text}\n"
+            text += f"# TYPE filesender_upload_{name} {kind}\n"
+            text += f"filesender_upload_{name} {value}\n"
+        # write then rename so readers never see a partial file
+        for ext, content in (('.prom', text), ('.json', json.dumps(snap, indent=1))):
+            with open(self.metrics + ext + '.tmp', 'w') as fout:
+                fout.write(content)
+            os.replace(self.metrics + ext + '.tmp', self.metrics + ext)
+
+    def run(self):
+        last_render = last_metrics = 0
+        while not self.stopped.wait(1):
+            now = time.time()
+            if self.show and now - last_render >= self.interval:
+                self.render(self.snapshot())
+                last_render = now
+            if self.metrics and now - last_metrics >= self.metrics_interval:
+                self.write_metrics(self.snapshot())
+                last_metrics = now
+
+    def log(self, message):
+        """prints a message without mangling the status line
+        """
+        if self.show and self.tty:
+            print('\r' + ' ' * (shutil.get_terminal_size().columns - 1) + '\r', end='')
+        print(message, flush=True)
+
+    def start(self):
+        if self.show or self.metrics:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            snap = self.snapshot()
+            if self.show:
+                self.render(snap, final=True)
+            if self.metrics:
+                self.write_metrics(snap)
+
+
+class TarBundle:
+    """A tar archive of small files that only exists as a list of segments: tar
+    headers and padding as bytes, file contents as (path, size). Its exact size is
+    known before postTransfer and any chunk of it can be read straight from the
+    source files, nothing is staged on disk. Headers are deterministic (no owner,
+    the file's mtime and mode) so a --resume rebuilds the same bundle.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.members = []
+        # segment i covers bytes starts[i] up to starts[i+1] of the archive
+        self.starts = []
+        self.sources = []
+        self.size = 0
+
+    def add_bytes(self, data):
+        if self.sources and isinstance(self.sources[-1], bytes):
+            # padding and the next header in one segment
+            self.sources[-1] += data
+        else:
+            self.starts.append(self.size)
+            self.sources.append(data)
+        self.size += len(data)
+
+    def add(self, path, name, st):
+        info = tarfile.TarInfo(name)
+        info.size = st.st_size
+        info.mtime = int(st.st_mtime)
+        info.mode = st.st_mode & 0o7777
+        self.add_bytes(info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape'))
+        if st.st_size:
+            self.starts.append(self.size)
+            self.sources.append((path, st.st_size))
+            self.size += st.st_size
+            if st.st_size % tarfile.BLOCKSIZE:
+                self.add_bytes(bytes(tarfile.BLOCKSIZE - st.st_size % tarfile.BLOCKSIZE))
+        self.members.append(name)
+
+    def close(self):
+        # end of archive: two zero blocks
+        self.add_bytes(bytes(2*tarfile.BLOCKSIZE))
+
+    def slice(self, offset, length):
+        """the part of the bundle needed for one chunk, small enough to send to a worker
+        """
+        part = TarBundle(self.name)
+        first = bisect.bisect_right(self.starts, offset) - 1
+        last = bisect.bisect_left(self.starts, offset + length)
+        part.starts = self.starts[first:last]
+        part.sources = self.sources[first:last]
+        part.size = self.size
+        return part
+
+    def readinto(self, buf, offset):
+        """fills memoryview buf from offset of the archive
+        """
+        i = bisect.bisect_right(self.starts, offset) - 1
+        n = 0
+        while n < len(buf):
+            start, source = self.starts[i], self.sources[i]
+            skip = offset + n - start
+            if isinstance(source, bytes):
+                count = min(len(source) - skip, len(buf) - n)
+                buf[n:n+count] = source[skip:skip+count]
+            else:
+                count = min(source[1] - skip, len(buf) - n)
+                with open(source[0], mode='rb', buffering=0) as fin:
+                    readinto_at(fin, buf[n:n+count], skip)
+            n += count
+            i += 1
+
+
+class SourceReader(io.RawIOBase):
+    """sequential reader of a TarBundle or CompressedFile, for the FileHasher and
+    the Compressor
+    """
+    def __init__(self, source):
+        self.source = source
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        n = max(0, min(len(buf), self.source.size - self.position))
+        self.source.readinto(memoryview(buf)[:n], self.position)
+        self.position += n
+        return n
+
+
+def open_source(path):
+    """unbuffered reader of an input file, a TarBundle or a CompressedFile
     """
-    fname = fileobject["name"]
-    fsize = fileobject["size"]
-    fstring = f"{fname}:{fsize}"
-    fpath = filesData[fstring]["path"]
+    if not isinstance(path, str):
+        return SourceReader(path)
+    return open(path, mode='rb', buffering=0)
 
-    try:
-        # putChunks
+
+class CompressedFile:
+    """zstd compressed content of an input file, in memory (data) or spooled to a
+    temporary file (spool), released once the server completed the file
+    """
+    def __init__(self, size, data=None, spool=None, offset=0, on_release=None):
+        self.size = size
+        self.data = data
+        self.spool = spool
+        # offset of data in the compressed file, for the slices sent to workers
+        self.offset = offset
+        self.on_release = on_release
+
+    def __getstate__(self):
+        # the callback stays in the main process
+        return dict(self.__dict__, on_release=None)
+
+    def slice(self, offset, length):
+        if self.data is None:
+            return self
+        return CompressedFile(self.size, data=self.data[offset:offset+length], offset=offset)
+
+    def readinto(self, buf, offset):
+        if self.data is not None:
+            start = offset - self.offset
+            buf[:] = self.data[start:start+len(buf)]
+        else:
+            with open(self.spool, mode='rb', buffering=0) as fin:
+                readinto_at(fin, buf, offset)
+
+    def release(self):
+        if self.data is not None and self.on_release is not None:
+            self.on_release(len(self.data))
+        self.data = None
+        if self.spool is not None and os.path.exists(self.spool):
+            os.remove(self.spool)
+
+
+# already compressed formats, not worth another pass
+COMPRESSED_SUFFIXES = ('.gz', '.bgz', '.bz2', '.xz', '.zst', '.zip', '.7z', '.bam', '.cram', '.tgz',
+                       '.png', '.jpg', '.jpeg', '.pdf', '.h5', '.sra')
+
+
+class Compressor:
+    """--compress zstd: compresses the files of a set before it is posted, as
+    FileSender needs the size of every file in postTransfer. Files above
+    MULTITHREAD_SIZE are compressed by zstd's multithreaded mode, which splits the
+    stream in blocks compressed on all cores, smaller files in parallel single
+    threaded. Compressed files stay in memory while they fit MEMORY_FILE_SIZE and
+    MEMORY_BUDGET, otherwise they are spooled to a temporary file. The next set is
+    compressed while the current one uploads, one set ahead to bound the spool.
+    A file that doesn't get smaller is sent as it is.
+    """
+    MULTITHREAD_SIZE = 64*1024**2
+    MEMORY_FILE_SIZE = 16*1024**2
+    MEMORY_BUDGET = 256*1024**2
+
+    def __init__(self, level=3, threads=None, spool_dir=None):
+        self.level = level
+        self.threads = threads or os.cpu_count() or 1
+        self.spool_dir = tempfile.mkdtemp(prefix='filesender-spool-', dir=spool_dir)
+        atexit.register(shutil.rmtree, self.spool_dir, True)
+        self.executor = ThreadPoolExecutor(self.threads)
+        self.lock = threading.Lock()
+        self.memory_used = 0
+        self.pending = {}
+
+    def start(self, set_index, files):
+        """starts compressing the files of a set in the background
+        """
+        if set_index not in self.pending:
+            self.pending[set_index] = [(key, self.executor.submit(self.compress, entry))
+                                       for key, entry in files.items()]
+
+    def result(self, set_index, files):
+        """the compressed files of a set as (files, filesTransfer)
+        """
+        self.start(set_index, files)
+        cfiles = {}
+        filesTransfer = []
+        for key, future in self.pending.pop(set_index):
+            entry = future.result()
+            cfiles[f"{entry['name']}:{entry['size']}"] = entry
+            filesTransfer.append({'name': entry['name'], 'size': entry['size']})
+        return cfiles, filesTransfer
+
+    def compress(self, entry):
+        if entry['name'].lower().endswith(COMPRESSED_SUFFIXES) or entry['size'] == 0:
+            return entry
+        in_memory = False
+        if entry['size'] <= self.MEMORY_FILE_SIZE:
+            with self.lock:
+                if self.memory_used + entry['size'] <= self.MEMORY_BUDGET:
+                    self.memory_used += entry['size']
+                    in_memory = True
+        start = time.time()
+        cctx = zstandard.ZstdCompressor(level=self.level, write_checksum=True,
+                                        threads=self.threads if entry['size'] >= self.MULTITHREAD_SIZE else 0)
+        with open_source(entry['path']) as fin:
+            if in_memory:
+                fout = io.BytesIO()
+                _, size = cctx.copy_stream(fin, fout, size=entry['size'], read_size=1024**2, write_size=1024**2)
+                source = CompressedFile(size, data=fout.getvalue(), on_release=self.release_memory)
+                with self.lock:
+                    self.memory_used += size - entry['size']
+            else:
+                fd, spool = tempfile.mkstemp(suffix='.zst', dir=self.spool_dir)
+                with os.fdopen(fd, 'wb') as fout:
+                    _, size = cctx.copy_stream(fin, fout, size=entry['size'], read_size=1024**2, write_size=1024**2)
+                source = CompressedFile(size, spool=spool)
+        seconds = time.time() - start
+        if size >= entry['size']:
+            source.release()
+            return entry
+        return {
+            **{k: v for k, v in entry.items() if k == 'members'},
+            'name': entry['name'] + '.zst',
+            'size': size,
+            'path': source,
+            'compression': {
+                'algorithm': 'zstd',
+                'original_name': entry['name'],
+                'original_size': entry['size'],
+                'ratio': entry['size'] / size,
+                'seconds': seconds
+            }
+        }
+
+    def release_memory(self, nbytes):
+        with self.lock:
+            self.memory_used -= nbytes
+
+
+class FileHasher:
+    """Checksums of the uploaded files (--checksum, off by default, sha256 with --dedup)
+    for the reports and the manifest. Chunks go out of order over many workers, but a digest needs
+    the bytes of a file in order, so every file is hashed sequentially by one thread
+    of a small pool that follows right behind the chunks the server acknowledged.
+    The hashing threads read every file a second time, with their own reads: usually
+    from the page cache, as a worker just read those bytes, but files queued behind
+    busy hashing threads on a large upload may have been evicted by then and are read
+    from disk again. The digest is thus of the local file as read after the upload, not
+    of the bytes sent. Files are hashed in parallel and hashlib releases the GIL on
+    large blocks. The hashing threads never hold up the upload, but the second read
+    costs throughput, so they only run when a checksum is asked for.
+    """
+    def __init__(self, algorithm='sha256', threads=4, block_size=1024*1024):
+        self.algorithm = algorithm
+        self.block_size = block_size
+        self.executor = ThreadPoolExecutor(threads)
+        self.local = threading.local()
+        self.cond = threading.Condition()
+        # file id -> bytes acknowledged from the start of the file, and the
+        # acknowledged chunks beyond that as {offset: length}
+        self.frontier = {}
+        self.pending = {}
+        self.futures = {}
+        self.stopped = False
+
+    def add_file(self, file_id, path, size, acked=(), chunk_size=None):
+        """starts hashing a file, acked are offsets of chunks already on the server
+        from an interrupted run, a file without chunks left to upload is hashed at once
+        """
+        with self.cond:
+            self.frontier[file_id] = 0
+            self.pending[file_id] = {}
+            for offset in acked:
+                self.pending[file_id][offset] = min(chunk_size, size - offset)
+            self.advance(file_id)
+        self.futures[file_id] = self.executor.submit(self.hash_file, file_id, path, size)
+
+    def add_complete_file(self, file_id, path, size):
+        with self.cond:
+            self.frontier[file_id] = size
+            self.pending[file_id] = {}
+        self.futures[file_id] = self.executor.submit(self.hash_file, file_id, path, size)
+
+    def advance(self, file_id):
+        pending = self.pending[file_id]
+        while self.frontier[file_id] in pending:
+            self.frontier[file_id] += pending.pop(self.frontier[file_id])
+
+    def chunk_done(self, file_id, offset, length):
+        with self.cond:
+            self.pending[file_id][offset] = length
+            if offset == self.frontier[file_id]:
+                self.advance(file_id)
+                self.cond.notify_all()
+
+    def hash_file(self, file_id, path, size):
+        if getattr(self.local, 'buffer', None) is None:
+            self.local.buffer = memoryview(bytearray(self.block_size))
+        buf = self.local.buffer
+        digest = hashlib.new(self.algorithm)
+        offset = 0
+        with open_source(path) as fin:
+            while offset < size:
+                with self.cond:
+                    self.cond.wait_for(lambda: self.frontier[file_id] > offset or self.stopped)
+                    if self.stopped and self.frontier[file_id] <= offset:
+                        return None
+                    available = self.frontier[file_id]
+                while offset < available:
+                    n = fin.readinto(buf[:min(self.block_size, available - offset)])
+                    if not n:
+                        raise OSError(f'Unexpected end of file {path} at {offset}')
+                    digest.update(buf[:n])
+                    offset += n
+        with self.cond:
+            del self.frontier[file_id], self.pending[file_id]
+        return digest.hexdigest()
+
+    def release_after(self, file_id, source):
+        """releases a compressed source once its file is hashed
+        """
+        future = self.futures.get(file_id)
+        if future is None:
+            source.release()
+        else:
+            future.add_done_callback(lambda _: source.release())
+
+    def stop(self):
+        """wakes up the threads still waiting for chunks, e.g. after a failed upload
+        """
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+    def digest(self, file_id):
+        """waits for the hashing of one file, returns its hex digest or None
+        """
+        future = self.futures.get(file_id)
+        if future is None:
+            return None
+        try:
+            return future.result()
+        except Exception as e:
+            print(f"WARNING: unable to compute the {self.algorithm} of file {file_id}: {e}")
+            return None
+
+    def digests(self):
+        """waits for the hashing to finish, returns {file id: hex digest}
+        """
+        digests = {}
+        for file_id in self.futures:
+            digest = self.digest(file_id)
+            if digest is not None:
+                digests[file_id] = digest
+        self.executor.shutdown()
+        return digests
+
+
+def file_digest(path, algorithm):
+    with open(path, mode='rb', buffering=0) as fin:
+        return hashlib.file_digest(fin, algorithm).hexdigest()
+
+
+def partial_hash(path, size, block=64*1024):
+    """blake2b of the size and the first, middle and last block of a file, tells
+    files of the same size apart without reading them in full
+    """
+    digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(path, mode='rb', buffering=0) as fin:
+        if size <= 3*block:
+            digest.update(fin.read(size))
+        else:
+            for offset in (0, (size - block)//2, size - block):
+                digest.update(os.pread(fin.fileno(), block, offset))
+    return digest.hexdigest()
+
+
+def transfer_expires(tdata):
+    """expiry of a transfer as a timestamp, the servers's when it gives one
+    """
+    expires = tdata.get('expires')
+    if isinstance(expires, dict):
+        expires = expires.get('raw')
+    if not isinstance(expires, (int, float)):
+        expires = time.time() + default_transfer_days_valid*24*3600
+    return expires
+
+
+class UploadIndex:
+    """SQLite index of the files uploaded before (--dedup), a row per file sent with
+    its stat (device, inode, size, mtime), a partial hash, its checksum from the
+    upload and the transfer it went into. An unchanged file is found by its stat
+    alone; a copy by size and partial hash, confirmed by hashing the local file in
+    full, which only happens for such candidates. Only transfers to the same server
+    that have not expired count, expired rows are dropped. All lookups go through
+    an index, so they stay fast with millions of rows.
+    """
+    COLUMNS = "name, transfer_id, file_id, download_url, recipients, expires, checksum"
+
+    def __init__(self, path=None, base_url=None):
+        if path is None:
+            path = expanduser("~") + '/.filesender/upload_index.sqlite'
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.base_url = base_url
+        # several uploads may share the index; lookups happen while collecting the
+        # files, records in the report thread, never at the same time
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                base_url TEXT, dev INTEGER, inode INTEGER, size INTEGER, mtime_ns INTEGER,
+                partial TEXT, checksum TEXT, name TEXT, transfer_id INTEGER, file_id INTEGER,
+                download_url TEXT, recipients TEXT, expires REAL, uploaded REAL);
+            CREATE INDEX IF NOT EXISTS files_stat ON files (inode, dev, size, mtime_ns);
+            CREATE INDEX IF NOT EXISTS files_content ON files (size, partial);
+            CREATE INDEX IF NOT EXISTS files_expires ON files (expires);
+        """)
+        with self.db:
+            self.db.execute("DELETE FROM files WHERE expires < ?", (time.time(),))
+
+    def lookup(self, path, st):
+        """the still valid upload of a file with the same content, or None
+        """
+        if st.st_size == 0:
+            return None
+        now = time.time()
+        row = self.db.execute(
+            f"SELECT {self.COLUMNS} FROM files WHERE inode = ? AND dev = ? AND size = ? AND mtime_ns = ? "
+            "AND base_url = ? AND expires > ? ORDER BY expires DESC LIMIT 1",
+            (st.st_ino, st.st_dev, st.st_size, st.st_mtime_ns, self.base_url, now)).fetchone()
+        if row is not None:
+            return dict(row)
+        if self.db.execute("SELECT 1 FROM files WHERE size = ? LIMIT 1", (st.st_size,)).fetchone() is None:
+            return None
+        candidates = self.db.execute(
+            f"SELECT {self.COLUMNS} FROM files WHERE size = ? AND partial = ? AND base_url = ? AND expires > ? "
+            "AND checksum IS NOT NULL ORDER BY expires DESC",
+            (st.st_size, partial_hash(path, st.st_size), self.base_url, now)).fetchall()
+        digests = {}
+        for row in candidates:
+            algorithm, digest = row['checksum'].split(':', 1)
+            if algorithm not in digests:
+                digests[algorithm] = file_digest(path, algorithm)
+            if digests[algorithm] == digest:
+                return dict(row)
+        return None
+
+    def record(self, uploads, threads=4):
+        """adds the files of complete transfers, uploads are (path, stat, file, transfer)
+        """
+        now = time.time()
+
+        def row(upload):
+            path, st, f, tdata = upload
+            try:
+                partial = partial_hash(path, st.st_size)
+            except OSError:
+                return None
+            checksum = next((f"{a}:{f[a]}" for a in ("sha256", "sha1", "md5", "blake2b") if a in f), None)
+            return (self.base_url, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, partial, checksum,
+                    f['name'], tdata['id'], f['id'], tdata['recipients'][0]['download_url'],
+                    ','.join(r['email'] for r in tdata['recipients']), transfer_expires(tdata), now)
+
+        with ThreadPoolExecutor(threads) as executor:
+            rows = [r for r in executor.map(row, uploads) if r is not None]
+        with self.db:
+            self.db.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def close(self):
+        self.db.close()
+
+
+class ChunkScheduler:
+    """Splits every file of the transfers into (file, offset) chunk tasks and keeps
+    track of which chunks the server has acknowledged, so that fileComplete is only
+    issued once all chunks of a file are in, and transferComplete once all files of
+    a transfer are complete.
+
+    sets is an iterator of (set index, transfer, filesData, resume state), it is
+    only advanced once all chunks of the previous set have been handed out, so the
+    next postTransfer happens while the tail of the current set is still in flight
+    and its chunks queue up right behind it.
+    """
+    def __init__(self, sets, upload_chunk_size, journal=None, monitor=None, hasher=None, reporter=None):
+        self.sets = sets
+        self.upload_chunk_size = upload_chunk_size
+        self.journal = journal
+        self.monitor = monitor
+        self.hasher = hasher
+        self.reporter = reporter
+        self.transfers = {}
+        self.fileobjects = {}
+        self.paths = {}
+        self.file_set = {}
+        self.remaining = {}
+        # files with all chunks acknowledged waiting for fileComplete, and
+        # sets with all files complete waiting for transferComplete
+        self.ready_files = []
+        self.ready_sets = []
+        # transferComplete responses by set index
+        self.responses = {}
+        # time from the first chunk sent to fileComplete, by file id
+        self.file_start = {}
+        self.file_seconds = {}
+
+    def add_set(self, set_index, transferData, filesData, resume=None):
+        """registers the files of a transfer, returns them largest first
+        """
+        # chunks and files already acknowledged in an interrupted run
+        acked = resume['acked'] if resume else {}
+        completed = resume['completed'] if resume else set()
+        # largest files first so the big ones don't end up as the long tail
+        files = sorted([f for f in transferData['files'] if f['id'] not in completed],
+                       key=lambda x: x['size'], reverse=True)
+        if self.monitor is not None:
+            self.monitor.add_done(sum(f['size'] for f in transferData['files'] if f['id'] in completed),
+                                  len(transferData['files']) - len(files))
+        self.transfers[set_index] = {
+            'transfer': transferData,
+            'files_remaining': len(files),
+            'stats': {'chunks': 0, 'retries': 0}
+        }
+        if self.hasher is not None:
+            for f in transferData['files']:
+                if f['id'] in completed:
+                    self.hasher.add_complete_file(f['id'], filesData[f"{f['name']}:{f['size']}"]['path'], f['size'])
+        for f in files:
+            self.fileobjects[f['id']] = f
+            self.paths[f['id']] = filesData[f"{f['name']}:{f['size']}"]['path']
+            if self.hasher is not None:
+                self.hasher.add_file(f['id'], self.paths[f['id']], f['size'], acked.get(f['id'], ()),
+                                     self.upload_chunk_size)
+            self.file_set[f['id']] = set_index
+            self.remaining[f['id']] = len(range(0, f['size'], self.upload_chunk_size)) - len(acked.get(f['id'], ()))
+            self.transfers[set_index]['stats']['chunks'] += self.remaining[f['id']]
+            if self.monitor is not None:
+                self.monitor.add_file(f, sum(min(self.upload_chunk_size, f['size'] - offset)
+                                             for offset in acked.get(f['id'], ())))
+            if self.remaining[f['id']] == 0:
+                self.ready_files.append(f)
+        if not files:
+            self.ready_sets.append(set_index)
+        return files, acked
+
+    def tasks(self):
+        """generator of chunk tasks, fed to the workers through the pool's shared queue
+        """
+        for set_index, transferData, filesData, resume in self.sets:
+            yield from self.set_tasks(set_index, transferData, filesData, resume)
+
+    def set_tasks(self, set_index, transferData, filesData, resume=None):
+        """generator of the chunk tasks of one set, registered with add_set first
+        """
+        files, acked = self.add_set(set_index, transferData, filesData, resume)
+        for f in files:
+            fobj = {'id': f['id'], 'uid': f['uid'], 'size': f['size']}
+            file_acked = acked.get(f['id'], ())
+            self.file_start[f['id']] = time.time()
+            for offset in range(0, f['size'], self.upload_chunk_size):
+                if offset in file_acked:
+                    continue
+                length = min(self.upload_chunk_size, f['size'] - offset)
+                path = self.paths[f['id']]
+                if not isinstance(path, str):
+                    path = path.slice(offset, length)
+                yield (path, fobj, transferData['roundtriptoken'], offset, length)
+
+    def chunk_done(self, file_id, offset, length, retries=0):
+        """record an acknowledged chunk, the file becomes ready once all its chunks are in
+        """
+        if self.journal is not None:
+            self.journal.write_chunk(file_id, offset)
+        if self.monitor is not None:
+            self.monitor.chunk_done(file_id, length, retries)
+        if self.hasher is not None:
+            self.hasher.chunk_done(file_id, offset, length)
+        self.transfers[self.file_set[file_id]]['stats']['retries'] += retries
+        self.remaining[file_id] -= 1
+        if self.remaining[file_id] == 0:
+            self.ready_files.append(self.fileobjects[file_id])
+
+    def pop_ready_files(self):
+        ready, self.ready_files = self.ready_files, []
+        return ready
+
+    def pop_ready_sets(self):
+        ready, self.ready_sets = self.ready_sets, []
+        return ready
+
+    def transfer_of(self, fileobject):
+        return self.transfers[self.file_set[fileobject['id']]]['transfer']
+
+    def file_done(self, fileobject):
+        """record an acknowledged fileComplete, the set becomes ready once all its files are complete
+        """
+        if self.journal is not None:
+            self.journal.write_file_complete(fileobject['id'])
+        if self.monitor is not None:
+            self.monitor.file_done(fileobject['id'])
+        set_index = self.file_set.pop(fileobject['id'])
+        source = self.paths.pop(fileobject['id'])
+        if hasattr(source, 'release'):
+            # compressed data is not needed any more, once it is hashed
+            if self.hasher is not None:
+                self.hasher.release_after(fileobject['id'], source)
+            else:
+                source.release()
+        del self.fileobjects[fileobject['id']], self.remaining[fileobject['id']]
+        now = time.time()
+        self.file_seconds[fileobject['id']] = now - self.file_start.pop(fileobject['id'], now)
+        self.transfers[set_index]['files_remaining'] -= 1
+        if self.transfers[set_index]['files_remaining'] == 0:
+            self.ready_sets.append(set_index)
+
+    def transfer_done(self, set_index, response):
+        """record an acknowledged transferComplete
+        """
+        if self.journal is not None:
+            self.journal.write_transfer_complete(set_index, response)
+        for f in response.get('files', []):
+            if f['id'] in self.file_seconds:
+                f['upload_seconds'] = self.file_seconds.pop(f['id'])
+        del self.transfers[set_index]
+        self.responses[set_index] = response
+        if self.reporter is not None:
+            self.reporter.transfer_done(set_index, response)
+
+
+# longest wait between two attempts of a chunk, in seconds
+RETRY_BACKOFF_CAP = 60
+
+
+def is_retryable(e):
+    """Transient errors worth retrying: connection problems, timeouts, 5xx, 408 and 429
+    """
+    if isinstance(e, HttpError):
+        return e.code is not None and (e.code >= 500 or e.code in (408, 429))
+    if requests is not None and isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                                               requests.exceptions.ChunkedEncodingError)):
+        return True
+    if aiohttp is not None and isinstance(e, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError,
+                                              asyncio.TimeoutError)):
+        return True
+    return False
+
+
+def backoff_delay(attempt):
+    """exponential backoff with full jitter, so workers don't retry in lockstep
+    """
+    return random.uniform(0, min(RETRY_BACKOFF_CAP, retry_backoff * 2**attempt))
+
+
+def take_retry(budget):
+    """takes one retry from the budget shared by all workers, False once it is used up
+    """
+    if budget is None:
+        return True
+    with budget.get_lock():
+        if budget.value <= 0:
+            return False
+        budget.value -= 1
+        return True
+
+
+class ConcurrencyController:
+    """Number of chunks in flight. Fixed at maximum, unless adaptive: then it starts
+    low and doubles while throughput keeps improving, afterwards grows by one per
+    interval while throughput still improves (AIMD). It is halved when chunks needed
+    retries, and cut by a quarter when latency goes up without a throughput gain.
+    With auto the first chunks calibrate it instead: 1, 2, 4, ... chunks in flight are
+    measured in turn until throughput stops improving, retries show the server
+    throttling, or maximum is reached. The lowest level within 5% of the best
+    throughput is kept for the rest of the upload (and tuned further if adaptive),
+    and the expected completion time of total_size bytes is printed.
+    """
+    def __init__(self, maximum, adaptive=False, interval=2.0, auto=False, total_size=0):
+        self.maximum = maximum
+        self.adaptive = adaptive
+        self.auto = auto
+        self.interval = interval
+        self.window = 1 if auto else min(2, maximum) if adaptive else maximum
+        self.max_window = self.window
+        self.slow_start = not auto
+        self.throughput = 0
+        self.latency = None
+        self.total_size = total_size
+        self.done_bytes = 0
+        self.levels = {}
+        self.log = print
+        self.reset()
+
+    def reset(self):
+        self.t0 = time.time()
+        self.n_bytes = 0
+        self.n_chunks = 0
+        self.elapsed = 0
+        self.retries = 0
+
+    def record(self, result):
+        """adds a finished chunk, returns True when the window changed
+        """
+        self.n_bytes += result['length']
+        self.n_chunks += 1
+        self.elapsed += result['elapsed']
+        self.retries += result['retries']
+        self.done_bytes += result['length']
+        if self.auto:
+            # a level is measured over twice its chunks, the first ones still ran at the previous level
+            if time.time() - self.t0 < self.interval / 2 or self.n_chunks < 2 * self.window:
+                return False
+        elif not self.adaptive or time.time() - self.t0 < self.interval or self.n_chunks < self.window:
+            return False
+        old_window = self.window
+        throughput = self.n_bytes / (time.time() - self.t0)
+        if self.auto:
+            self.calibrate(throughput, self.elapsed / self.n_chunks, self.retries)
+        else:
+            self.update(throughput, self.elapsed / self.n_chunks, self.retries)
+        self.reset()
+        return self.window != old_window
+
+    def calibrate(self, throughput, latency, retries):
+        self.levels[self.window] = throughput
+        best = max(self.levels.values())
+        if not retries and throughput >= best and throughput > self.throughput * 1.05 and self.window < self.maximum:
+            self.throughput = throughput
+            self.latency = latency
+            self.window = min(self.maximum, self.window * 2)
+            self.max_window = max(self.max_window, self.window)
+            if debug:
+                print(f"calibrating: {throughput/1024**2:.1f} MB/s, {latency:.2f}s per chunk, "
+                      f"trying {self.window} chunks in flight")
+            return
+        # fewer chunks in flight for the same throughput hold less memory and stress the server less
+        self.window = min(level for level, rate in self.levels.items() if rate >= best * 0.95)
+        self.throughput = self.levels[self.window]
+        self.latency = None
+        self.auto = False
+        levels = ', '.join(f"{level}: {rate/1024**2:.1f}" for level, rate in sorted(self.levels.items()))
+        message = f"auto: {self.window} chunks in flight, {self.throughput/1024**2:.1f} MB/s ({levels} MB/s)"
+        remaining = self.total_size - self.done_bytes
+        if remaining > 0 and self.throughput > 0:
+            eta = remaining / self.throughput
+            message += (f", ETA {int(eta//3600)}:{int(eta%3600//60):02d}:{int(eta%60):02d} for the remaining "
+                        f"{remaining/1024**3:.2f} GB (around {datetime.fromtimestamp(time.time() + eta):%Y-%m-%d %H:%M})")
+        self.log(message)
+
+    def update(self, throughput, latency, retries):
+        if retries:
+            self.window = max(1, self.window // 2)
+            self.slow_start = False
+        elif throughput > self.throughput * 1.05:
+            self.window = min(self.maximum, self.window * 2 if self.slow_start else self.window + 1)
+        elif self.latency is not None and latency > self.latency * 1.25:
+            self.window = max(1, self.window - max(1, self.window // 4))
+            self.slow_start = False
+        else:
+            self.slow_start = False
+        self.throughput = throughput
+        self.latency = latency
+        self.max_window = max(self.max_window, self.window)
         if debug:
-            print('putChunks: '+fpath)
+            print(f"concurrency: {self.window} chunks in flight "
+                  f"({throughput/1024**2:.1f} MB/s, {latency:.2f}s per chunk, {retries} retries)")
+
+
+def parse_size(size):
+    """'200M' -> 209715200, K/M/G/T are multiples of 1024, a plain number is bytes
+    """
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+    size = str(size).strip().upper().rstrip('B')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(float(size))
+
+
+class RateLimiter:
+    """Token bucket shared by all upload workers, processes or coroutines, so that
+    --max-rate caps the total rate. A worker reserves the bytes of a chunk before
+    sending it and sleeps for as long as the bucket needs to refill. The bucket holds
+    at most burst bytes, or one second worth of the rate if burst is 0. The rate is
+    in shared memory so the main process can change it during the upload, 0 means
+    no limit.
+    """
+    def __init__(self, rate, burst=0):
+        self.lock = Lock()
+        self.rate = Value('d', rate, lock=False)
+        self.burst = Value('d', burst, lock=False)
+        self.tokens = Value('d', burst or rate, lock=False)
+        self.last = Value('d', time.time(), lock=False)
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate.value = rate
+
+    def reserve(self, nbytes):
+        """takes nbytes from the bucket, returns the seconds to wait before sending them
+        """
+        with self.lock:
+            rate = self.rate.value
+            if rate <= 0:
+                return 0
+            now = time.time()
+            burst = self.burst.value or rate
+            self.tokens.value = min(burst, self.tokens.value + (now - self.last.value) * rate) - nbytes
+            self.last.value = now
+            if self.tokens.value >= 0:
+                return 0
+            return -self.tokens.value / rate
+
+
+class RateSchedule:
+    """Time of day schedule for the RateLimiter, one range per line, first match wins:
+
+        # HH:MM-HH:MM  rate
+        08:00-18:00    200M
+        18:00-08:00    0
+
+    ranges can wrap around midnight, outside of all ranges default_rate applies.
+    The file is re-read when it changes, so the schedule of a long upload can be
+    edited while it runs.
+    """
+    def __init__(self, path, limiter, default_rate, interval=10):
+        self.path = path
+        self.limiter = limiter
+        self.default_rate = default_rate
+        self.interval = interval
+        self.mtime = None
+        self.ranges = []
+
+    def load(self):
+        mtime = os.path.getmtime(self.path)
+        if mtime == self.mtime:
+            return
+        ranges = []
+        with open(self.path) as fin:
+            for line in fin:
+                line = line.split('#')[0].strip()
+                if not line:
+                    continue
+                span, rate = line.split()
+                start, end = [int(t.split(':')[0])*60 + int(t.split(':')[1]) for t in span.split('-')]
+                ranges.append((start, end, parse_size(rate)))
+        self.ranges = ranges
+        self.mtime = mtime
+
+    def current_rate(self, now=None):
+        now = now or datetime.now()
+        minute = now.hour*60 + now.minute
+        for start, end, rate in self.ranges:
+            if start <= minute < end or (end < start and (minute >= start or minute < end)):
+                return rate
+        return self.default_rate
+
+    def update(self):
+        try:
+            self.load()
+        except Exception as e:
+            # keep the last good schedule while the file is being edited
+            print(f"WARNING: unable to read rate schedule {self.path}: {e}")
+        rate = self.current_rate()
+        if rate != self.limiter.rate.value:
+            if debug:
+                print(f"upload rate limit: {rate/1024**2:.1f} MB/s" if rate else "upload rate limit: none")
+            self.limiter.set_rate(rate)
+
+    def run(self):
+        while True:
+            self.update()
+            time.sleep(self.interval)
+
+    def start(self):
+        self.update()
+        threading.Thread(target=self.run, daemon=True).start()
+
+
+# FileSender's browser side encryption, key version 1: AES-256-CBC with a key derived
+# from the password by PBKDF2-SHA256 and the transfer's salt. Every chunk is encrypted
+# on its own and sent as a random IV followed by the PKCS#7 padded ciphertext, which
+# makes an encrypted chunk of upload_chunk_size bytes upload_crypted_chunk_size long.
+ENCRYPTION_KEY_VERSION = 1
+ENCRYPTION_HASH_ITERATIONS = 150000
+CRYPTO_IV_LEN = 16
+
+
+def encryption_key_from_password(password, salt, iterations=ENCRYPTION_HASH_ITERATIONS):
+    return hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt.encode('utf-8'), iterations, 32)
+
+
+def encrypted_length(length):
+    """size of a chunk of length bytes once encrypted
+    """
+    return CRYPTO_IV_LEN + (length // 16 + 1) * 16
+
+
+def encrypted_size(size, chunk_size):
+    full, rest = divmod(size, chunk_size)
+    return full * encrypted_length(chunk_size) + (encrypted_length(rest) if rest else 0)
+
+
+def encrypt_chunk(key, data, out):
+    """encrypts memoryview data into the start of buffer out, which holds at least
+    encrypted_length(len(data)) + 15 bytes, returns the encrypted chunk as a memoryview
+    """
+    out = memoryview(out)
+    iv = os.urandom(CRYPTO_IV_LEN)
+    out[:CRYPTO_IV_LEN] = iv
+    encryptor = ciphers.Cipher(ciphers.algorithms.AES(key), ciphers.modes.CBC(iv)).encryptor()
+    full = len(data) - len(data) % 16
+    n = CRYPTO_IV_LEN + encryptor.update_into(data[:full], out[CRYPTO_IV_LEN:])
+    pad = 16 - len(data) % 16
+    n += encryptor.update_into(bytes(data[full:]) + bytes([pad]) * pad, out[n:])
+    encryptor.finalize()
+    return out[:n]
+
+
+_fin = None
+_buffer = None
+_crypt_buffer = None
+_retry_budget = None
+_limiter = None
+
+
+def chunk_buffer(size):
+    """Chunk buffer of this worker, allocated once and reused for every chunk
+    """
+    global _buffer
+    if _buffer is None or len(_buffer) < size:
+        _buffer = bytearray(size)
+    return _buffer
+
+
+def crypt_buffer(size):
+    """Buffer of this worker for the encrypted chunk
+    """
+    global _crypt_buffer
+    if _crypt_buffer is None or len(_crypt_buffer) < encrypted_length(size) + 15:
+        _crypt_buffer = bytearray(encrypted_length(size) + 15)
+    return _crypt_buffer
+
+
+def readinto_at(fin, buf, offset):
+    """Fills memoryview buf from offset of an unbuffered file, without allocating
+    """
+    fin.seek(offset)
+    n = 0
+    while n < len(buf):
+        read = fin.readinto(buf[n:])
+        if not read:
+            raise OSError(f'Unexpected end of file {fin.name} at {offset+n}')
+        n += read
+
+
+def source_ranges(path, offset, length):
+    """(file, offset, length) of the files on disk behind a chunk of an input file,
+    a TarBundle slice or a spooled CompressedFile
+    """
+    if isinstance(path, str):
+        return [(path, offset, length)]
+    if isinstance(path, CompressedFile):
+        return [(path.spool, offset, length)] if path.spool is not None else []
+    ranges = []
+    for start, source in zip(path.starts, path.sources):
+        if isinstance(source, bytes):
+            continue
+        skip = max(0, offset - start)
+        count = min(source[1] - skip, offset + length - start - skip)
+        if count > 0:
+            ranges.append((source[0], skip, count))
+    return ranges
+
+
+class ReadAhead:
+    """Keeps disk reads ahead of the workers: chunk tasks are handed out depth tasks
+    behind the scheduler, and as a task enters that window a few threads prefetch its
+    chunk into the page cache (posix_fadvise WILLNEED, a plain read where that is not
+    available). The workers' reads then hit memory while other chunks are being sent.
+    At most depth chunks are prefetched beyond the ones handed out.
+    """
+    def __init__(self, depth, chunk_size, threads=2):
+        self.depth = depth
+        self.chunk_size = chunk_size
+        self.executor = ThreadPoolExecutor(threads)
+        self.local = threading.local()
+
+    def prefetch(self, task):
+        fpath, fileobject, roundtriptoken, offset, length = task
+        for path, start, count in source_ranges(fpath, offset, length):
+            try:
+                with open(path, mode='rb', buffering=0) as fin:
+                    if hasattr(os, 'posix_fadvise'):
+                        os.posix_fadvise(fin.fileno(), start, count, os.POSIX_FADV_WILLNEED)
+                    else:
+                        if getattr(self.local, 'buf', None) is None:
+                            self.local.buf = bytearray(self.chunk_size)
+                        readinto_at(fin, memoryview(self.local.buf)[:count], start)
+            except Exception:
+                # only a hint, the worker reports the error when it reads the chunk
+                pass
+
+    def tasks(self, tasks):
+        window = deque()
+        try:
+            for task in tasks:
+                window.append(task)
+                self.executor.submit(self.prefetch, task)
+                if len(window) > self.depth:
+                    yield window.popleft()
+            while window:
+                yield window.popleft()
+        finally:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def init_worker(retry_budget, limiter):
+    """Pool initializer, the retry budget and the rate limiter are shared by all workers
+    """
+    global _retry_budget, _limiter
+    _retry_budget = retry_budget
+    _limiter = limiter
+
+
+def upload_chunk(task):
+    """This is the mp worker: uploads a single chunk of a file, retrying transient
+    errors with backoff, and returns what the main process needs for bookkeeping
+    and reporting
+    """
+    global _fin
+    fpath, fileobject, roundtriptoken, offset, length = task
+
+    start = time.time()
+    data = memoryview(chunk_buffer(length))[:length]
+    if not isinstance(fpath, str):
+        fpath.readinto(data, offset)
+    else:
+        # workers tend to get consecutive chunks of the same file, keep it open
+        if _fin is None or _fin.name != fpath:
+            if _fin is not None:
+                _fin.close()
+            _fin = open(fpath, mode='rb', buffering=0)
+            if hasattr(os, 'posix_fadvise'):
+                # larger kernel read-ahead for the following chunks
+                os.posix_fadvise(_fin.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        readinto_at(_fin, data, offset)
+    if encryption_key is not None:
+        # encrypting here spreads it over the worker processes, and it overlaps
+        # with the other workers' sends
+        data = encrypt_chunk(encryption_key, data, crypt_buffer(length))
+    retries = 0
+    while True:
+        if _limiter is not None:
+            time.sleep(_limiter.reserve(len(data)))
+        try:
+            putChunk({'roundtriptoken': roundtriptoken}, fileobject, data, offset)
+            break
+        except Exception as e:
+            if retries >= max_retries or not is_retryable(e) or not take_retry(_retry_budget):
+                if isinstance(e, HttpError):
+                    raise
+                # requests exceptions keep the request and its memoryview body,
+                # which can't be pickled back to the main process
+                raise HttpError(f"{type(e).__name__} on {fpath} chunk {offset}: {e}", None) from None
+            retries += 1
+            if debug:
+                print(f"retry {retries}/{max_retries} of {fpath} chunk {offset}: {e}")
+            time.sleep(backoff_delay(retries))
+    return {
+        'file_id': fileobject['id'],
+        'offset': offset,
+        'length': length,
+        'elapsed': time.time() - start,
+        'retries': retries,
+        'pid': os.getpid(),
+        'connections': connection_stats()
+    }
+
+
+def upload_transfers(sets, upload_chunk_size, n_procs, debug, journal=None, retry_budget=None, adaptive=False,
+                     limiter=None, monitor=None, hasher=None, read_ahead=0, auto=False, total_size=0,
+                     reporter=None, total_chunks=0):
+    """Uploads the files of all transfers chunk by chunk over one pool of n_procs workers,
+    issuing fileComplete as soon as the last chunk of a file has been acknowledged and
+    transferComplete as soon as the last file of a transfer is complete.
+    With adaptive, the number of chunks in flight is tuned between 1 and n_procs,
+    with auto it is calibrated on the first chunks (see ConcurrencyController),
+    with read_ahead that many chunks are prefetched ahead of the workers. Complete
+    transfers are handed to reporter as they come in. With total_chunks, no more workers
+    are started than there are chunks to send.
+    Returns the transferComplete responses by set index and the connection stats of the workers.
+    """
+    if total_chunks:
+        n_procs = min(n_procs, total_chunks)
+    scheduler = ChunkScheduler(sets, upload_chunk_size, journal, monitor, hasher, reporter)
+    controller = ConcurrencyController(max(1, n_procs), adaptive, auto=auto, total_size=total_size)
+    if monitor is not None:
+        controller.log = monitor.log
+    worker_stats = {}
+
+    def complete_ready():
+        for fileobject in scheduler.pop_ready_files():
+            if debug:
+                print('fileComplete: '+fileobject['name'])
+            fileComplete(scheduler.transfer_of(fileobject), fileobject)
+            scheduler.file_done(fileobject)
+        for set_index in scheduler.pop_ready_sets():
+            if debug:
+                print('transferComplete')
+            response = transferComplete(scheduler.transfers[set_index]['transfer'])
+            response['upload_stats'] = dict(scheduler.transfers[set_index]['stats'],
+                                            concurrency=controller.window, max_concurrency=controller.max_window)
+            scheduler.transfer_done(set_index, response)
+            if progress and monitor is not None:
+                monitor.log(f"Upload Complete: transfer {response['id']}")
+
+    if debug:
+        print(f"putChunks over {controller.maximum} workers")
+    chunk_count = 0
+    results = queue.Queue()
+    tasks = scheduler.tasks()
+    if read_ahead:
+        tasks = ReadAhead(read_ahead, upload_chunk_size).tasks(tasks)
+    inflight = 0
+    with Pool(controller.maximum, initializer=init_worker, initargs=(retry_budget, limiter)) as pool:
+        while True:
+            # without adaptive keep one chunk queued per worker, so no worker waits on this loop
+            limit = controller.window if adaptive or auto else 2 * controller.maximum
+            while inflight < limit:
+                task = next(tasks, None)
+                # the next set may have been posted with files that have no chunks
+                complete_ready()
+                if task is None:
+                    break
+                pool.apply_async(upload_chunk, (task,), callback=results.put, error_callback=results.put)
+                inflight += 1
+            if inflight == 0:
+                break
+            if monitor is not None:
+                monitor.set_active(min(inflight, controller.maximum))
+
+            result = results.get()
+            inflight -= 1
+            if isinstance(result, BaseException):
+                raise result
+            worker_stats[result['pid']] = result['connections']
+            controller.record(result)
+            if debug:
+                chunk_count += 1
+                print(f"uploaded {chunk_count} chunks")
+            scheduler.chunk_done(result['file_id'], result['offset'], result['length'], result['retries'])
+            complete_ready()
+
+    return scheduler.responses, list(worker_stats.values())
+
+
+def read_chunk(fpath, buf, offset, crypt_buf=None):
+    """Reads one chunk into memoryview buf, runs in the async engine's reader threads.
+    Returns the chunk to send, encrypted into crypt_buf with --encrypt.
+    """
+    if not isinstance(fpath, str):
+        fpath.readinto(buf, offset)
+    else:
         with open(fpath, mode='rb', buffering=0) as fin:
-            chunk_count = 0
-            for offset in range(0, fsize, upload_chunk_size):
-                if progress:
-                    print('Uploading: '+fpath+' '+str(offset)+'-'+str(min(offset +
-                        upload_chunk_size, fsize))+' '+str(round(offset/fsize*100))+'%')
-                data = fin.read(upload_chunk_size)
-                # print(data)
-                putChunk(transferData, fileobject, data, offset)
+            readinto_at(fin, buf, offset)
+    if encryption_key is not None:
+        return encrypt_chunk(encryption_key, buf, crypt_buf)
+    return buf
+
+
+def connection_trace(stats):
+    """aiohttp trace hooks counting new connections and requests, so the async
+    engine can report the same connection stats as the session of the pool workers
+    """
+    async def on_connection_create_end(session, context, params):
+        stats['connections'] += 1
+
+    async def on_request_start(session, context, params):
+        stats['requests'] += 1
+
+    trace = aiohttp.TraceConfig()
+    trace.on_connection_create_end.append(on_connection_create_end)
+    trace.on_request_start.append(on_request_start)
+    return trace
+
+
+async def upload_transfers_async(sets, upload_chunk_size, max_inflight, read_threads, debug, journal=None,
+                                 retry_budget=None, adaptive=False, limiter=None, monitor=None, hasher=None,
+                                 read_ahead=0, auto=False, total_size=0, reporter=None):
+    """asyncio alternative to upload_transfers: max_inflight coroutines pull chunk tasks
+    from the same scheduler and send them over one aiohttp connection pool, file reads
+    go to a small thread pool. At most max_inflight chunks are held in memory, with
+    adaptive the number of chunks in flight is tuned between 1 and max_inflight.
+    Returns the transferComplete responses by set index and the connection stats.
+    """
+    scheduler = ChunkScheduler(sets, upload_chunk_size, journal, monitor, hasher, reporter)
+    controller = ConcurrencyController(max(1, max_inflight), adaptive, auto=auto, total_size=total_size)
+    if monitor is not None:
+        controller.log = monitor.log
+    stats = {'connections': 0, 'requests': 0}
+    chunk_count = 0
+    active = 0
+
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(read_threads)
+    connector = aiohttp.TCPConnector(limit=controller.maximum)
+    window_changed = asyncio.Condition()
+    async with aiohttp.ClientSession(connector=connector, trace_configs=[connection_trace(stats)]) as session:
+
+        async def complete_ready():
+            for fileobject in scheduler.pop_ready_files():
+                if debug:
+                    print('fileComplete: '+fileobject['name'])
+                await fileCompleteAsync(session, scheduler.transfer_of(fileobject), fileobject)
+                scheduler.file_done(fileobject)
+            for set_index in scheduler.pop_ready_sets():
+                if debug:
+                    print('transferComplete')
+                response = await transferCompleteAsync(session, scheduler.transfers[set_index]['transfer'])
+                response['upload_stats'] = dict(scheduler.transfers[set_index]['stats'],
+                                                concurrency=controller.window, max_concurrency=controller.max_window)
+                scheduler.transfer_done(set_index, response)
+                if progress and monitor is not None:
+                    monitor.log(f"Upload Complete: transfer {response['id']}")
+
+        async def send(buf, crypt_buf, fpath, fileobject, roundtriptoken, offset, length):
+            start = time.time()
+            data = memoryview(buf)[:length]
+            data = await loop.run_in_executor(executor, read_chunk, fpath, data, offset, crypt_buf)
+            retries = 0
+            while True:
+                if limiter is not None:
+                    await asyncio.sleep(limiter.reserve(len(data)))
+                try:
+                    await putChunkAsync(session, {'roundtriptoken': roundtriptoken}, fileobject, data, offset)
+                    break
+                except Exception as e:
+                    if retries >= max_retries or not is_retryable(e) or not take_retry(retry_budget):
+                        raise
+                    retries += 1
+                    if debug:
+                        print(f"retry {retries}/{max_retries} of {fpath} chunk {offset}: {e}")
+                    await asyncio.sleep(backoff_delay(retries))
+            return {'length': length, 'elapsed': time.time() - start, 'retries': retries}
+
+        # the next set is taken from the sets generator in a thread: posting the transfer and
+        # preparing its files (--compress) block, the chunks in flight keep going meanwhile
+        sets = iter(scheduler.sets)
+        set_executor = ThreadPoolExecutor(1)
+        set_tasks = iter(())
+        tasks_lock = asyncio.Lock()
+
+        async def next_task():
+            """the next chunk task, None once all sets are handed out"""
+            nonlocal set_tasks
+            async with tasks_lock:
+                while True:
+                    task = next(set_tasks, None)
+                    if task is not None:
+                        return task
+                    set_item = await loop.run_in_executor(set_executor, next, sets, None)
+                    if set_item is None:
+                        return None
+                    set_tasks = scheduler.set_tasks(*set_item)
+                    if read_ahead:
+                        set_tasks = ReadAhead(read_ahead, upload_chunk_size).tasks(set_tasks)
+
+        async def worker():
+            nonlocal chunk_count, active
+            # one chunk buffer per coroutine, reused for all its chunks
+            buf = bytearray(upload_chunk_size)
+            crypt_buf = bytearray(encrypted_length(upload_chunk_size) + 15) if encryption_key is not None else None
+            # every worker pulls from the same tasks, so chunks are handed out in order
+            while True:
+                task = await next_task()
+                if task is None:
+                    break
+                fpath, fileobject, roundtriptoken, offset, length = task
+                # the next set may have been posted with files that have no chunks
+                await complete_ready()
+                async with window_changed:
+                    await window_changed.wait_for(lambda: active < controller.window)
+                    active += 1
+                if monitor is not None:
+                    monitor.set_active(active)
+                try:
+                    result = await send(buf, crypt_buf, fpath, fileobject, roundtriptoken, offset, length)
+                finally:
+                    async with window_changed:
+                        active -= 1
+                        window_changed.notify_all()
+                if controller.record(result):
+                    async with window_changed:
+                        window_changed.notify_all()
                 if debug:
                     chunk_count += 1
                     print(f"uploaded {chunk_count} chunks")
-        # file complete
+                scheduler.chunk_done(fileobject['id'], offset, length, result['retries'])
+                await complete_ready()
+
         if debug:
-            print('fileComplete: '+fpath)
-        fileComplete(transferData, fileobject)
-        if progress:
-            print('Uploading: '+fpath+' '+str(size)+' 100%')
-    except Exception as e:
-        raise(e)
+            print(f"putChunks, {controller.maximum} in flight")
+        try:
+            await asyncio.gather(*[worker() for _ in range(controller.maximum)])
+            # sets at the end that had no chunks left to send
+            await complete_ready()
+        finally:
+            executor.shutdown(wait=False)
+            set_executor.shutdown(wait=False)
+
+    return scheduler.responses, [stats]
+
+
+def walk_inputs(paths, include=(), exclude=()):
+    """Generator of (absolute path, name) of the files to send. Files given explicitly
+    are named by their basename, directories are walked with os.scandir and their
+    files named by their path relative to the parent of the directory, so the same
+    basename in different subdirectories stays apart. include/exclude are globs on
+    that relative name, an excluded directory is not walked at all. Symlinks to
+    directories are followed, except to a directory that is being walked already,
+    which would loop. Entries are sorted per directory so the sets come out the same
+    for --resume.
+    """
+    def walk(dpath, rel, parents):
+        with os.scandir(dpath) as it:
+            entries = sorted(it, key=lambda e: e.name)
+        for entry in entries:
+            name = rel + '/' + entry.name
+            if any(fnmatch(name, pattern) for pattern in exclude):
+                continue
+            if entry.is_dir():
+                st = entry.stat()
+                if (st.st_dev, st.st_ino) in parents:
+                    print(f"WARNING: not following {entry.path}, it links back to a directory above it")
+                    continue
+                yield from walk(entry.path, name, parents | {(st.st_dev, st.st_ino)})
+            elif entry.is_file() and (not include or any(fnmatch(name, pattern) for pattern in include)):
+                yield entry.path, name
+
+    for path in paths:
+        fn_abs = os.path.abspath(path)
+        if os.path.isdir(fn_abs):
+            st = os.stat(fn_abs)
+            yield from walk(fn_abs, os.path.basename(fn_abs.rstrip('/')), {(st.st_dev, st.st_ino)})
+        else:
+            yield fn_abs, os.path.basename(fn_abs)
 
 
-def transfer_data_to_text(tdata):
+def stat_inputs(entries, threads):
+    """(path, name, os.stat result) of the (path, name) entries in the same order,
+    stat'ed by a bounded thread pool so the latency of network filesystems overlaps,
+    at most a few stats per thread are in flight
+    """
+    with ThreadPoolExecutor(threads) as executor:
+        window = deque()
+        for path, name in entries:
+            window.append((path, name, executor.submit(os.stat, path)))
+            if len(window) >= 4 * threads:
+                path, name, st = window.popleft()
+                yield path, name, st.result()
+        for path, name, st in window:
+            yield path, name, st.result()
+
+
+def transfer_report_lines(tdata):
+    """the text report of a transfer, in pieces to write out one by one
+    """
     total_size = 0
     for f in tdata["files"]:
         total_size += f["size"]
@@ -256,316 +2063,888 @@ def transfer_data_to_text(tdata):
         size_str = f"{total_size:.2f} {size_unit}"
 
     url = tdata["recipients"][0]["download_url"]
-    report_txt = f"""FileSender upload
+    yield f"""FileSender upload
 transfer ID: {tdata["id"]}
 uploaded by: {tdata["user_email"]}
 total size:  {size_str}
 
 recipient:   {tdata["recipients"][0]["email"]}
 D/L link:    {url}
+"""
+    if tdata.get("encrypted"):
+        yield """encrypted:   yes, the recipients need the password
+"""
+
+    if "upload_stats" in tdata:
+        upload_stats = tdata["upload_stats"]
+        yield f"""
+chunks:      {upload_stats["chunks"]:,} ({upload_stats["retries"]:,} retries)
+concurrency: {upload_stats["concurrency"]} chunks in flight (max {upload_stats.get("max_concurrency", upload_stats["concurrency"])})
+"""
 
+    yield """
 Files uploaded:
 """
 
     for fidx, f in enumerate(tdata["files"]):
         url = f"https://filesender.aarnet.edu.au/download.php?token={tdata['recipients'][0]['token']}&files_ids={f['id']}"
         ct_str = f"{fidx}".rjust( len(str(len(tdata["files"]))) )
-        report_txt += f"""
+        yield f"""
 {ct_str}: "{f["name"]}"
 {" "*len(ct_str)}  {f["size"]:,} bytes 
 {" "*len(ct_str)}  {url}
 """
+        if f.get("upload_seconds"):
+            yield f"""{" "*len(ct_str)}  uploaded in {f["upload_seconds"]:.1f} s, {f["size"]/f["upload_seconds"]/1024**2:.1f} MB/s
+"""
+        for algorithm in ("sha256", "sha1", "md5", "blake2b"):
+            if algorithm in f:
+                yield f"""{" "*len(ct_str)}  {algorithm}: {f[algorithm]}
+"""
+        if "compression" in f:
+            compression = f["compression"]
+            yield f"""{" "*len(ct_str)}  {compression["algorithm"]} of "{compression["original_name"]}", {compression["original_size"]:,} bytes, ratio {compression["ratio"]:.2f}
+"""
+            if f.get("upload_seconds"):
+                yield f"""{" "*len(ct_str)}  effective throughput {compression["original_size"]/f["upload_seconds"]/1024**2:.1f} MB/s
+"""
+        if "duplicate_of" in f:
+            yield f"""{" "*len(ct_str)}  same content as "{f["duplicate_of"]}"
+"""
+        if "previous" in f:
+            yield f"""{" "*len(ct_str)}  also in transfer {f["previous"]["transfer_id"]} as "{f["previous"]["name"]}": {f["previous"]["download_url"]}
+"""
+        if "members" in f:
+            yield f"""{" "*len(ct_str)}  tar bundle of {len(f["members"]):,} files:
+"""
+            for member in f["members"]:
+                yield f"""{" "*len(ct_str)}    {member}
+"""
 
-    return report_txt
-
-
-
-# -------------------------------------------------------------------------------
-
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-# settings
-base_url = 'https://filesender.aarnet.edu.au/rest.php'
-default_transfer_days_valid = 21
-username = None
-apikey = None
-homepath = expanduser("~")
-recipients = None
-
-config = configparser.ConfigParser()
-config.read(homepath + '/.filesender/filesender.py.ini')
-if 'system' in config:
-    base_url = config['system'].get(
-        'base_url', 'https://filesender.aarnet.edu.au/rest.php')
-    default_transfer_days_valid = int(
-        config['system'].get('default_transfer_days_valid', 10))
-if 'user' in config:
-    username = config['user'].get('username')
-    apikey = config['user'].get('apikey')
-
-if 'recipients' in config:
-    recipients = config['recipients'].get('recipients')
-
-# argv
-parser = argparse.ArgumentParser()
-parser.add_argument("files", help="path to file(s) to send", nargs='+')
-parser.add_argument("-v", "--verbose", action="store_true")
-parser.add_argument("-i", "--insecure", action="store_true")
-parser.add_argument("-p", "--progress", action="store_true")
-parser.add_argument("-s", "--subject", default="", type=str)
-parser.add_argument("-m", "--message", default="", type=str)
-parser.add_argument("-k", "--skip-email", action="store_true", default=False, help="Don't send email to recipient")
-parser.add_argument("-n", "--n_procs", default=1, type=int, help="number of parallel uploads")
-
-# if we have found these in the config file they become optional arguments
-requiredNamed = parser.add_argument_group('required named arguments')
-if username is None:
-    requiredNamed.add_argument("-u", "--username", required=True)
-else:
-    parser.add_argument("-u", "--username")
-
-if apikey is None:
-    requiredNamed.add_argument("-a", "--apikey", required=True)
-else:
-    parser.add_argument("-a", "--apikey")
-if recipients is None:
-    requiredNamed.add_argument("-r", "--recipients", required=True)
-else:
-    parser.add_argument("-r", "--recipients")
-
-
-# final reporting logs
-parser.add_argument("--report", "-R", type=str, help="filepath for transfer report")
-# reporttype = parser.add_mutually_exclusive_group(required=True)
-parser.add_argument("--report-json", "-j", action="store_true", help="Output transfer report in JSON")
-parser.add_argument("--report-text", "-t", action="store_true", help="Output transfer report in text (default)")
-# parser.add_argument("--report-both", "-b", action="store_true", help="Report both JSON and txt formats")
-parser.add_argument("--quiet", "-q", action="store_true", help="Quiet mode. No report.")
-
-args = parser.parse_args()
-debug = args.verbose
-progress = args.progress
-insecure = args.insecure
-n_procs = args.n_procs
-skip_email = args.skip_email
-
-if args.username is not None:
-    username = args.username
-
-if args.apikey is not None:
-    apikey = args.apikey
-
-if args.recipients is not None:
-    recipients = args.recipients
+def transfer_data_to_text(tdata):
+    return "".join(transfer_report_lines(tdata))
 
 
-# -------------------------------------------------------------------------------
+def already_sent_lines(files):
+    yield """Files not uploaded, sent before in transfers that have not expired:
+"""
+    for fidx, f in enumerate(files):
+        ct_str = f"{fidx}".rjust(len(str(len(files))))
+        previous = f["previous"]
+        yield f"""
+{ct_str}: "{f["name"]}"
+{" "*len(ct_str)}  {f["size"]:,} bytes
+{" "*len(ct_str)}  transfer {previous["transfer_id"]} to {previous["recipients"]} as "{previous["name"]}", until {datetime.fromtimestamp(previous["expires"]):%Y-%m-%d}
+{" "*len(ct_str)}  {previous["download_url"]}
+"""
 
 
-# -------------------------------------------------------------------------------
-# test API, get info
-
-# configs
-try:
-    response = requests.get(base_url+'/info', verify=True)
-except requests.exceptions.SSLError as exc:
-    if not insecure:
-        print('Error: the SSL certificate of the server you are connecting to cannot be verified:')
-        print(exc)
-        print('For more information, please refer to https://www.digicert.com/ssl/. If you are absolutely certain of the identity of the server you are connecting to, you can use the --insecure flag to bypass this warning. Exiting...')
-        sys.exit(1)
-    elif insecure:
-        print('Warning: Error: the SSL certificate of the server you are connecting to cannot be verified:')
-        print(exc)
-        print('Running with --insecure flag, ignoring warning...')
-        response = requests.get(base_url+'/info', verify=False)
-upload_chunk_size = response.json()['upload_chunk_size']
+class ReportWriter:
+    """Writes the reports while the upload goes on: a background thread writes every
+    transfer as soon as it is complete to PREFIX.txt, PREFIX.json, PREFIX.ndjson and
+    the PREFIX.<checksum> manifest, so nothing piles up in memory and the reports of
+    the sets done so far are there even if a later one fails. Without a prefix they
+    are spooled to temporary files and printed at the end, the status line may be on
+    screen during the upload.
 
-# -------------------------------------------------------------------------------
-# test local file output
-
-write_to_stdout = True
-outprefix = None
-outdir = None
-if args.report:
-    outprefix = os.path.abspath(args.report)
-    outdir = os.path.dirname(outprefix)
-    try:
-        os.makedirs(outdir, exist_ok=True)
-        fout = open(outprefix+".test", "w")
-        fout.write("")
-        fout.close()
-        os.remove(outprefix + ".test")
-        write_to_stdout = False
-    except Exception as e:
-        print("""
-###########
-# WARNING #
-###########
-Unable to write output to specified location. Printing to stdout instead
-""")
-        outprefix = None
-        write_to_stdout = True
+    The JSON report is {"transfers": [...]} with every set, the NDJSON report has a
+    line per transfer (without its files) followed by a line per file.
+    prepare(set_index, response) completes a response before it is written.
+    """
+    def __init__(self, outprefix, n_sets, text=True, json_report=False, ndjson=False, checksum=None, prepare=None):
+        self.outprefix = outprefix
+        self.n_sets = n_sets
+        self.checksum = checksum
+        self.prepare = prepare
+        self.streams = {}
+        for kind, enabled in (('txt', text), ('json', json_report), ('ndjson', ndjson), (checksum, checksum)):
+            if enabled:
+                if outprefix:
+                    self.streams[kind] = open(f"{outprefix}.{kind}", "w")
+                else:
+                    self.streams[kind] = tempfile.TemporaryFile("w+")
+        if 'txt' in self.streams and n_sets > 1:
+            self.streams['txt'].write(f"There were more than 1,000 files uploaded, so upload data were split into {n_sets} transfers\n")
+        if 'json' in self.streams:
+            self.streams['json'].write('{"transfers": [')
+        self.n_written = 0
+        self.error = None
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def transfer_done(self, set_index, response):
+        self.queue.put((set_index, response))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                self.write_transfer(*item)
+            except Exception as e:
+                self.error = e
+
+    def write_transfer(self, set_index, response):
+        if self.prepare is not None:
+            self.prepare(set_index, response)
+        fout = self.streams.get('txt')
+        if fout is not None:
+            if self.n_sets > 1:
+                fout.write(f"\nSet {set_index+1}:\n\n")
+            fout.writelines(transfer_report_lines(response))
+            if self.n_sets > 1:
+                fout.write("\n\n-------------------------------\n")
+        fout = self.streams.get('json')
+        if fout is not None:
+            fout.write(",\n" if self.n_written else "\n")
+            json.dump(response, fout)
+        fout = self.streams.get('ndjson')
+        if fout is not None:
+            fout.write(json.dumps({'type': 'transfer', 'set': set_index,
+                                   **{k: v for k, v in response.items() if k != 'files'}}) + "\n")
+            for f in response['files']:
+                fout.write(json.dumps({'type': 'file', 'set': set_index, 'transfer_id': response['id'], **f}) + "\n")
+        fout = self.streams.get(self.checksum)
+        if fout is not None:
+            for f in response['files']:
+                if self.checksum in f:
+                    fout.write(f"{f[self.checksum]}  {f['name']}\n")
+        for fout in self.streams.values():
+            fout.flush()
+        self.n_written += 1
+
+    def close(self, already_sent=()):
+        """waits for the transfers handed in so far to be written, finishes the reports
+        """
+        self.queue.put(None)
+        self.thread.join()
+        if already_sent:
+            if 'txt' in self.streams:
+                self.streams['txt'].write("\n" if self.n_written else "")
+                self.streams['txt'].writelines(already_sent_lines(already_sent))
+            if 'ndjson' in self.streams:
+                for f in already_sent:
+                    self.streams['ndjson'].write(json.dumps({'type': 'already_sent', **f}) + "\n")
+        if 'json' in self.streams:
+            self.streams['json'].write("\n]")
+            if already_sent:
+                self.streams['json'].write(', "already_sent": ' + json.dumps(list(already_sent)))
+            self.streams['json'].write("}\n")
+        if not self.outprefix:
+            titles = {self.checksum: f"{self.checksum} checksums", 'txt': "Text Report",
+                      'json': "JSON Report", 'ndjson': "NDJSON Report"}
+            for kind in (self.checksum, 'txt', 'json', 'ndjson'):
+                if kind in self.streams:
+                    fout = self.streams[kind]
+                    fout.seek(0)
+                    print(f"\n\n#-----------------------------\n# {titles[kind]}\n")
+                    shutil.copyfileobj(fout, sys.stdout)
+                    print("\n")
+        for fout in self.streams.values():
+            fout.close()
+        if self.error is not None:
+            raise self.error
 
-WRITE_JSON = args.report_json
-WRITE_TEXT = args.report_text
-QUIET = args.quiet
 
-if not WRITE_JSON and not WRITE_TEXT:
-    WRITE_TEXT = True
 
 # -------------------------------------------------------------------------------
 
-file_list_short_string = ",".join(args.files)
-if len(args.files) > 6:
-    file_list_short_string = ",".join( args.files[:3] ) + "..." + ",".join( args.files[-3:] )
-
-
-if debug:
-    print('base_url          : '+base_url)
-    print('username          : '+username)
-    print('apikey            : '+apikey)
-    print('upload_chunk_size : '+str(upload_chunk_size)+' bytes')
-    print('recipients        : '+recipients)
-    print('files             : '+','.join(args.files))
-    print('insecure          : '+str(insecure))
+# settings, set for the whole process by Uploader.configure(): the pool workers
+# inherit them from the main process
+base_url = 'https://filesender.aarnet.edu.au/rest.php'
+default_transfer_days_valid = 21
+username = None
+apikey = None
+insecure = False
+debug = False
+progress = False
+max_retries = 5
+retry_backoff = 1.0
+# AES key of --encrypt
+encryption_key = None
 
+SPLIT_LIMIT = 1000
 
-##########################################################################
+MAX_PER_SPLIT = int(0.95*SPLIT_LIMIT)
 
-# -------------------------------------------------------------------------------
-# Start upload process
+# seconds the /info of a server is cached in ~/.filesender/info_cache.json
+INFO_CACHE_TTL = 24*3600
 
-SPLIT_LIMIT = 1000
 
-MAX_PER_SPLIT = int(0.95*SPLIT_LIMIT)
+def read_config(path=None):
+    """settings from ~/.filesender/filesender.py.ini, only those present
+    """
+    if path is None:
+        path = expanduser("~") + '/.filesender/filesender.py.ini'
+    config = configparser.ConfigParser()
+    config.read(path)
+    settings = {}
+    if 'system' in config:
+        settings['base_url'] = config['system'].get(
+            'base_url', 'https://filesender.aarnet.edu.au/rest.php')
+        settings['default_transfer_days_valid'] = int(
+            config['system'].get('default_transfer_days_valid', 10))
+    if 'user' in config:
+        settings['username'] = config['user'].get('username')
+        settings['apikey'] = config['user'].get('apikey')
+    if 'recipients' in config:
+        settings['recipients'] = config['recipients'].get('recipients')
+    return settings
+
+
+def get_info(base_url, insecure=False, ttl=INFO_CACHE_TTL, cache_path=None):
+    """GET /info of the server (upload_chunk_size etc.), cached on disk for ttl
+    seconds so short uploads don't wait for a round trip before the first chunk
+    """
+    if cache_path is None:
+        cache_path = expanduser("~") + '/.filesender/info_cache.json'
+    cache = {}
+    try:
+        with open(cache_path) as fin:
+            cache = json.load(fin)
+    except (OSError, ValueError):
+        pass
+    entry = cache.get(base_url)
+    if ttl > 0 and entry is not None and 0 <= time.time() - entry['time'] < ttl:
+        return entry['info']
+
+    load_requests()
+    try:
+        response = get_session().get(base_url+'/info', verify=True)
+    except requests.exceptions.SSLError as exc:
+        if not insecure:
+            raise UploadError(f'the SSL certificate of the server you are connecting to cannot be verified:\n{exc}\n'
+                              'For more information, please refer to https://www.digicert.com/ssl/. If you are '
+                              'absolutely certain of the identity of the server you are connecting to, you can use '
+                              'the --insecure flag to bypass this warning. Exiting...')
+        print('Warning: Error: the SSL certificate of the server you are connecting to cannot be verified:')
+        print(exc)
+        print('Running with --insecure flag, ignoring warning...')
+        response = get_session().get(base_url+'/info', verify=False)
+    info = response.json()
+
+    if ttl > 0:
+        cache[base_url] = {'time': time.time(), 'info': info}
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            with open(cache_path + '.tmp', 'w') as fout:
+                json.dump(cache, fout)
+            os.replace(cache_path + '.tmp', cache_path)
+        except OSError as e:
+            if debug:
+                print(f"unable to cache /info in {cache_path}: {e}")
+    return info
+
+
+def make_parser(settings=None):
+    """the command line options, also the options and defaults of Uploader.
+    username, apikey and recipients are required unless found in the config settings.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", help="path to file(s) or directories to send", nargs='*')
+    parser.add_argument("--files-from", type=str, help="read paths to send from a file, one per line ('-' for stdin)")
+    parser.add_argument("--include", action="append", default=[],
+                        help="only send files of directories matching this glob on the relative path, can be repeated")
+    parser.add_argument("--exclude", action="append", default=[],
+                        help="skip files and directories matching this glob on the relative path, can be repeated")
+    parser.add_argument("--pack-below", type=str, default="0",
+                        help="send files smaller than this (e.g. 1M) in tar bundles, built on the fly (default: off)")
+    parser.add_argument("--pack-size", type=str, default="1G", help="target size of the tar bundles of --pack-below")
+    parser.add_argument("--compress", choices=["none", "zstd"], default="none",
+                        help="compress files before sending them as <name>.zst (needs zstandard)")
+    parser.add_argument("--compress-level", default=3, type=int, help="zstd compression level")
+    parser.add_argument("--compress-threads", default=0, type=int,
+                        help="number of compression threads (default: all cores)")
+    parser.add_argument("--spool-dir", type=str,
+                        help="directory for compressed files too large to keep in memory (default: TMPDIR)")
+    parser.add_argument("--stat-threads", default=16, type=int, help="number of parallel file stats")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    parser.add_argument("-i", "--insecure", action="store_true")
+    parser.add_argument("-p", "--progress", action="store_true",
+                        help="show a status line with total rate, ETA and files in progress")
+    parser.add_argument("--metrics", type=str,
+                        help="path prefix of metrics files refreshed during the upload: PREFIX.prom (Prometheus textfile) and PREFIX.json")
+    parser.add_argument("--metrics-interval", default=10, type=int, help="seconds between metrics file refreshes")
+    parser.add_argument("-s", "--subject", default="", type=str)
+    parser.add_argument("-m", "--message", default="", type=str)
+    parser.add_argument("-k", "--skip-email", action="store_true", default=False, help="Don't send email to recipient")
+    parser.add_argument("-n", "--n_procs", default=1, type=int, help="number of parallel uploads")
+    parser.add_argument("--engine", choices=["pool", "async"], default="pool",
+                        help="upload engine: multiprocessing pool of n_procs workers (default) or asyncio")
+    parser.add_argument("--max-inflight", default=64, type=int, help="number of chunks in flight with --engine async")
+    parser.add_argument("--read-threads", default=4, type=int, help="number of file reader threads with --engine async")
+    parser.add_argument("--read-ahead", default=4, type=int,
+                        help="number of chunks read into the page cache ahead of the uploads, 0 = off")
+    parser.add_argument("--retries", default=5, type=int, help="number of retries per chunk on transient errors")
+    parser.add_argument("--retry-budget", default=1000, type=int, help="total number of chunk retries before giving up")
+    parser.add_argument("--backoff", default=1.0, type=float,
+                        help="base delay in seconds of the exponential backoff between retries")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="tune the number of chunks in flight to the network, up to --n_procs or --max-inflight")
+    parser.add_argument("--auto", action="store_true",
+                        help="calibrate the number of chunks in flight on the first chunks, up to --auto-max, "
+                             "and print the expected completion time")
+    parser.add_argument("--auto-max", default=32, type=int,
+                        help="most chunks in flight tried by --auto (pool workers or async coroutines)")
+    parser.add_argument("--max-rate", type=str, default="0",
+                        help="cap on the total upload rate in bytes/s over all workers, e.g. 200M (K/M/G = 1024 multiples), 0 = no cap")
+    parser.add_argument("--burst", type=str, default="0", help="burst size in bytes for --max-rate (default: one second worth)")
+    parser.add_argument("--rate-schedule", type=str,
+                        help="file with time of day ranges and rates, e.g. '08:00-18:00 200M', re-read while uploading")
+    parser.add_argument("--encrypt", action="store_true",
+                        help="encrypt the files with a password (needs cryptography), as FileSender's browser "
+                             "encryption, recipients decrypt them in the browser")
+    parser.add_argument("--password-file", type=str,
+                        help="file with the --encrypt password (default: $FILESENDER_ENCRYPTION_PASSWORD or a prompt)")
+    parser.add_argument("--checksum", choices=["sha256", "sha1", "md5", "blake2b", "none"],
+                        help="checksum of every file for the reports and a <report>.<checksum> manifest, the "
+                             "local files are read a second time to compute it (default: none, sha256 with --dedup)")
+    parser.add_argument("--hash-threads", default=4, type=int, help="number of files hashed in parallel")
+    parser.add_argument("--connection-stats", action="store_true",
+                        help="Report HTTP connections opened (handshakes) and reused")
+    parser.add_argument("--dedup", choices=["off", "report", "skip"], default="off",
+                        help="keep an index of uploaded files in ~/.filesender: report files sent before and "
+                             "duplicates within the upload, or skip files still available in an earlier transfer")
+    parser.add_argument("--dedup-index", type=str, help="path of the --dedup index (default: ~/.filesender/upload_index.sqlite)")
+    parser.add_argument("--info-ttl", default=INFO_CACHE_TTL, type=int,
+                        help="seconds the server's /info is cached in ~/.filesender, 0 = always ask the server")
+
+    # if we have found these in the config file they become optional arguments
+    requiredNamed = parser.add_argument_group('required named arguments')
+    for short, name in (("-u", "username"), ("-a", "apikey"), ("-r", "recipients")):
+        if settings is not None and settings.get(name) is None:
+            requiredNamed.add_argument(short, "--"+name, required=True)
+        else:
+            parser.add_argument(short, "--"+name)
+
+    # final reporting logs
+    parser.add_argument("--report", "-R", type=str, help="filepath for transfer report")
+    # reporttype = parser.add_mutually_exclusive_group(required=True)
+    parser.add_argument("--report-json", "-j", action="store_true", help="Output transfer report in JSON")
+    parser.add_argument("--report-text", "-t", action="store_true", help="Output transfer report in text (default)")
+    parser.add_argument("--report-ndjson", action="store_true",
+                        help="Output transfer report as newline delimited JSON, a line per transfer and per file")
+    # parser.add_argument("--report-both", "-b", action="store_true", help="Report both JSON and txt formats")
+    parser.add_argument("--quiet", "-q", action="store_true", help="Quiet mode. No report.")
+    parser.add_argument("--journal", type=str,
+                        help="filepath for the chunk journal used by --resume (default: report prefix + .journal)")
+    parser.add_argument("--resume", type=str,
+                        help="resume an interrupted upload from its journal, same files must be given")
+    return parser
+
+
+class Uploader:
+    """Uploads files and directories to FileSender, the same as the command line:
+
+        uploader = Uploader(recipients='someone@example.org', n_procs=8, quiet=True)
+        transfers = uploader.upload(['run_dir'], report='reports/run')
+
+    Options are the long command line options with '_' for '-' and the same
+    defaults, server and user settings not given come from
+    ~/.filesender/filesender.py.ini (or config_file). upload() returns the
+    transferComplete response of every transfer, with checksums, bundles and
+    compression of the files merged in. Problems are raised as UploadError, a
+    failed request (HttpError, requests and aiohttp errors) or file access (OSError)
+    with the original exception as its __cause__.
+
+    With encrypt=True the password is taken from password, else as on the command
+    line from --password-file, $FILESENDER_ENCRYPTION_PASSWORD or a prompt.
+
+    The settings are module globals shared with the forked pool workers, so one
+    Uploader uploads at a time per process.
+    """
+    def __init__(self, config_file=None, base_url=None, default_transfer_days_valid=None, password=None,
+                 **options):
+        self.password = password
+        self.settings = {
+            'base_url': 'https://filesender.aarnet.edu.au/rest.php',
+            'default_transfer_days_valid': 21,
+            'username': None,
+            'apikey': None,
+            'recipients': None
+        }
+        self.settings.update(read_config(config_file))
+        if base_url is not None:
+            self.settings['base_url'] = base_url
+        if default_transfer_days_valid is not None:
+            self.settings['default_transfer_days_valid'] = default_transfer_days_valid
+        self.options = make_parser().parse_args([])
+        for name, value in options.items():
+            if not hasattr(self.options, name):
+                raise TypeError(f"Uploader got an unexpected option '{name}'")
+            setattr(self.options, name, value)
+        for name in ('username', 'apikey', 'recipients'):
+            if getattr(self.options, name) is not None:
+                self.settings[name] = getattr(self.options, name)
+
+    def configure(self):
+        """sets the module settings used by the REST calls and the workers
+        """
+        global base_url, default_transfer_days_valid, username, apikey, insecure, debug, progress
+        global max_retries, retry_backoff
+        for name in ('username', 'apikey', 'recipients'):
+            if not self.settings[name]:
+                raise UploadError(f"no {name} given and none in ~/.filesender/filesender.py.ini")
+        base_url = self.settings['base_url']
+        default_transfer_days_valid = self.settings['default_transfer_days_valid']
+        username = self.settings['username']
+        apikey = self.settings['apikey']
+        insecure = self.options.insecure
+        debug = self.options.verbose
+        progress = self.options.progress
+        max_retries = self.options.retries
+        retry_backoff = self.options.backoff
+
+    def read_password(self, confirm):
+        if self.password:
+            return self.password
+        if self.options.password_file:
+            with open(self.options.password_file) as fin:
+                return fin.readline().rstrip('\n')
+        if os.environ.get('FILESENDER_ENCRYPTION_PASSWORD'):
+            return os.environ['FILESENDER_ENCRYPTION_PASSWORD']
+        if not sys.stdin.isatty():
+            raise UploadError("--encrypt needs a password: --password-file or $FILESENDER_ENCRYPTION_PASSWORD")
+        password = getpass.getpass("Encryption password: ")
+        if confirm and getpass.getpass("Repeat the password: ") != password:
+            raise UploadError("the passwords do not match")
+        if not password:
+            raise UploadError("empty encryption password")
+        return password
+
+    def setup_encryption(self):
+        """derives the key of --encrypt, with the salt of the transfers being resumed,
+        the key goes to a module global for the workers
+        """
+        global encryption_key
+        encryption_key = None
+        self.encryption = None
+        resumed = [state['transfer'].get('encryption_details') for state in self.resume_state.values()]
+        if (self.options.encrypt and None in resumed) or (not self.options.encrypt and any(resumed)):
+            raise UploadError(f"--encrypt must be given for all or none of the runs of journal {self.options.resume}")
+        if not self.options.encrypt:
+            return
+        if resumed:
+            self.encryption_details = resumed[0]
+        else:
+            self.encryption_details = {'salt': secrets.token_urlsafe(24), 'iterations': ENCRYPTION_HASH_ITERATIONS,
+                                       'key_version': ENCRYPTION_KEY_VERSION}
+        password = self.read_password(confirm=not resumed)
+        encryption_key = encryption_key_from_password(password, self.encryption_details['salt'],
+                                                      self.encryption_details['iterations'])
+        self.encryption = {
+            'encryption': True,
+            'encryption_key_version': self.encryption_details['key_version'],
+            'encryption_salt': self.encryption_details['salt'],
+            'encryption_password_encoding': 'none',
+            'encryption_password_version': 1,
+            'encryption_password_hash_iterations': self.encryption_details['iterations']
+        }
 
-# postTransfer
-if debug:
-    print('postTransfer')
-
-n_sets = 1
-if len(args.files) < SPLIT_LIMIT:
-    input_file_list = [args.files]
-else:
-    # split into sets of 0.95*SPLIT_LIMIT files
-    input_file_list = []
-    n_sets = int(len(args.files) / MAX_PER_SPLIT )
-    if n_sets * 950 < len(args.files):
-        n_sets += 1
-    for n in range(n_sets):
-        input_file_list.append(  args.files[n*MAX_PER_SPLIT:(n+1)*MAX_PER_SPLIT]  )
-    
-
-
-# ------------------------
-# now iterate through sets of input_file_list
-
-Responses = []
-
-for file_set in range(n_sets):
-    # get input file list
-    files = {}
-    filesTransfer = []
-    for f in input_file_list[file_set]:
-        fn_abs = os.path.abspath(f)
-        fn = os.path.basename(fn_abs)
-        size = os.path.getsize(fn_abs)
-        files[fn+':'+str(size)] = {
+    def info(self):
+        return get_info(self.settings['base_url'], self.options.insecure, self.options.info_ttl)
+
+    # ------------------------
+    # walk the inputs and split them into sets of 0.95*SPLIT_LIMIT files as the stats
+    # come in, sizes of all sets are needed up front for the ETA
+
+    def add_input(self, fn_abs, fn, size, members=None):
+        if len(self.input_sets) == 1 and self.total_files == SPLIT_LIMIT - 1:
+            # more than fit in one transfer
+            files, filesTransfer = self.input_sets[0]
+            self.input_sets = [({}, []), ({}, [])]
+            for idx, f in enumerate(filesTransfer):
+                key = f"{f['name']}:{f['size']}"
+                self.input_sets[idx // MAX_PER_SPLIT][0][key] = files[key]
+                self.input_sets[idx // MAX_PER_SPLIT][1].append(f)
+        elif len(self.input_sets) > 1 and len(self.input_sets[-1][1]) == MAX_PER_SPLIT:
+            self.input_sets.append(({}, []))
+        files, filesTransfer = self.input_sets[-1]
+        key = fn+':'+str(size)
+        if key in files:
+            raise UploadError(f"{files[key]['path']} and {fn_abs} would both be sent as {fn}")
+        files[key] = {
             'name': fn,
             'size': size,
             'path': fn_abs
         }
+        if members is not None:
+            files[key]['members'] = members
         filesTransfer.append({'name': fn, 'size': size})
-
-    troptions = {'get_a_link': skip_email}
-
-    # sort by decreasing file size
-    filesTransfer = sorted(filesTransfer, key=lambda x: x["size"], reverse=True)
-    transfer = postTransfer(username,
-                            filesTransfer,
-                            recipients,
-                            subject=args.subject,
-                            message=args.message,
-                            expires=None,
-                            options=troptions)['created']
-
-    # ----------------------------------------------------------------------
-    # transferring data
-    n_procs = min(n_procs, len(filesTransfer))
-    task = partial(upload_file, 
-                transferData=transfer, 
-                filesData=files,
-                upload_chunk_size=upload_chunk_size,
-                debug=debug)
-    pool = Pool(n_procs)
-    pool.map(task, transfer['files'])
-    pool.close()
-
-    # transferComplete
-    if debug:
-        print('transferComplete')
-    finalResponse = transferComplete(transfer)
-    if progress:
-        print('Upload Complete')
-    Responses.append(finalResponse)
-
-# --------------------------------------------------
-
-if QUIET:
-    exit()
-
-# --------------------------------------------------
-if WRITE_TEXT:
-    if n_sets == 1:
-        report_text = transfer_data_to_text(Responses[0])
-    elif n_sets > 1:
-        report_text = f"There were more than 1,000 files uploaded, so upload data were split into {n_sets} transfers\n"
-
-        for n in range(n_sets):
-            report_text += f"""
-Set {n+1}:
-
-{transfer_data_to_text(Responses[n])}
-
--------------------------------
-"""
-    if outprefix:
-        fout = open(outprefix + ".txt", "w")
-        fout.write(report_text)
-        fout.close()
-    else:
-        print(f"""
-
-#-----------------------------
-# Text Report
-
-{report_text}              
-
-""")
-
-if WRITE_JSON:
-    if outprefix:
-        fout = open( outprefix + ".json", "w" )
-        fout.write( json.dumps(finalResponse) )
-        fout.close()
-    else:
-        print(f"""
-
-#-----------------------------
-# JSON Report
-
-{json.dumps(finalResponse, indent=1)}              
-
-
+        self.total_size += size
+        self.total_files += 1
+
+    def collect(self, paths):
+        """stats the files to send into self.input_sets, a (files, filesTransfer) per transfer
+        """
+        args = self.options
+        self.input_sets = [({}, [])]
+        self.total_size = 0
+        self.total_files = 0
+
+        # small files go into tar bundles of about pack_size, sent like any other file
+        pack_below = parse_size(args.pack_below)
+        pack_size = parse_size(args.pack_size)
+        bundle = None
+        self.n_bundles = 0
+        packed = {}
+        # files sent as they are can be found in the --dedup index
+        self.stats = {}
+        self.previous = {}
+        self.skipped = []
+        # files of a resumed journal went into the index as their sets completed, they
+        # are not earlier uploads and have to stay in their sets
+        resumed = set()
+        for resume in self.resume_state.values():
+            for f in resume['transfer']['files']:
+                resumed.update((f['name'], f['name'].removesuffix('.zst')))
+        for fn_abs, fn, st in stat_inputs(walk_inputs(paths, args.include, args.exclude), args.stat_threads):
+            if st.st_size >= pack_below:
+                if self.index is not None:
+                    previous = self.index.lookup(fn_abs, st) if fn not in resumed else None
+                    if previous is not None and args.dedup == "skip":
+                        self.skipped.append({'name': fn, 'size': st.st_size, 'path': fn_abs, 'previous': previous})
+                        continue
+                    if previous is not None:
+                        self.previous[fn_abs] = previous
+                    if args.compress == "none":
+                        self.stats[fn_abs] = st
+                self.add_input(fn_abs, fn, st.st_size)
+                continue
+            if fn in packed:
+                raise UploadError(f"{packed[fn]} and {fn_abs} would both be packed as {fn}")
+            packed[fn] = fn_abs
+            if bundle is None:
+                self.n_bundles += 1
+                bundle = TarBundle(f"bundle_{self.n_bundles:05d}.tar")
+            bundle.add(fn_abs, fn, st)
+            if bundle.size >= pack_size:
+                bundle.close()
+                self.add_input(bundle, bundle.name, bundle.size, bundle.members)
+                bundle = None
+        if bundle is not None:
+            bundle.close()
+            self.add_input(bundle, bundle.name, bundle.size, bundle.members)
+
+        if self.total_files == 0 and not self.skipped:
+            raise UploadError("no files to send")
+        if debug and self.skipped:
+            print(f"{len(self.skipped):,} files already sent")
+        if debug:
+            print(f"{self.total_files:,} files, {self.total_size:,} bytes in {len(self.input_sets)} transfer(s)")
+
+    def prepare_sets(self):
+        """Posts the transfers one set at a time, as the upload engine asks for the next
+        one. Sets of a resumed journal are not posted again.
+        """
+        args = self.options
+        n_sets = len(self.input_sets)
+        for file_set in range(n_sets):
+            files, filesTransfer = self.input_sets[file_set]
+            troptions = {'get_a_link': args.skip_email}
+
+            resume = self.resume_state.get(file_set)
+            if self.compressor is not None and not (resume is not None and resume['response'] is not None):
+                # compress the next set while this one uploads
+                if file_set + 1 < n_sets:
+                    self.compressor.start(file_set + 1, self.input_sets[file_set + 1][0])
+                files, filesTransfer = self.compressor.result(file_set, files)
+                if self.monitor is not None:
+                    self.monitor.add_total(sum(f['size'] for f in filesTransfer) -
+                                           sum(f['size'] for f in self.input_sets[file_set][1]))
+                self.input_sets[file_set] = (files, filesTransfer)
+            if resume is not None:
+                resumed_files = sorted(f"{f['name']}:{f['size']}" for f in resume['transfer']['files'])
+                expected = sorted(files.keys())
+                if self.compressor is not None and resume['response'] is not None:
+                    # complete sets are not compressed again, only the names can be compared
+                    resumed_files = sorted(f['name'].removesuffix('.zst') for f in resume['transfer']['files'])
+                    expected = sorted(f['name'] for f in filesTransfer)
+                if resumed_files != expected:
+                    raise UploadError(f"files of set {file_set+1} do not match the files in journal {args.resume}")
+                if resume['response'] is not None:
+                    if debug:
+                        print(f"set {file_set+1} already complete, transfer {resume['transfer']['id']}")
+                    self.responses[file_set] = resume['response']
+                    if self.monitor is not None:
+                        self.monitor.add_done(sum(f['size'] for f in filesTransfer), len(filesTransfer))
+                    if self.hasher is not None and self.compressor is None:
+                        for f in resume['response']['files']:
+                            self.hasher.add_complete_file(f['id'], files[f"{f['name']}:{f['size']}"]['path'],
+                                                          f['size'])
+                    self.reporter.transfer_done(file_set, resume['response'])
+                    continue
+                transfer = resume['transfer']
+                if debug:
+                    print(f"resuming transfer {transfer['id']}")
+            else:
+                if debug:
+                    print('postTransfer')
+                # sort by decreasing file size
+                filesTransfer = sorted(filesTransfer, key=lambda x: x["size"], reverse=True)
+                if self.encryption is not None:
+                    filesTransfer = [dict(f, encrypted_size=encrypted_size(f['size'], self.upload_chunk_size))
+                                     for f in filesTransfer]
+                transfer = postTransfer(username,
+                                        filesTransfer,
+                                        self.settings['recipients'],
+                                        subject=args.subject,
+                                        message=args.message,
+                                        expires=None,
+                                        options=troptions,
+                                        encryption=self.encryption)['created']
+                if self.encryption is not None:
+                    transfer['encryption_details'] = self.encryption_details
+                if self.journal is not None:
+                    self.journal.write_transfer(file_set, transfer)
+            yield file_set, transfer, files, resume
+
+    def upload(self, files=None, report=None):
+        """uploads files and directories, returns the transferComplete responses
+        """
+        try:
+            args = self.options
+            if files is None:
+                files = args.files
+            if report is not None:
+                args.report = report
+            self.configure()
+            if args.engine == "async":
+                load_aiohttp()
+            if args.compress == "zstd":
+                load_zstandard()
+            if args.encrypt:
+                load_cryptography()
+                if args.dedup != "off":
+                    raise UploadError("--dedup can't be used with --encrypt, the earlier uploads may not be encrypted")
+            if args.checksum is None:
+                # copies are only found by their content with checksums
+                args.checksum = "sha256" if args.dedup != "off" else "none"
+
+            retry_budget = Value('i', args.retry_budget)
+            max_rate = parse_size(args.max_rate)
+            limiter = None
+            if max_rate or args.rate_schedule:
+                limiter = RateLimiter(max_rate, parse_size(args.burst))
+
+            # ------------------------
+            # get the server's settings, from the cache when fresh
+
+            info = self.info()
+            upload_chunk_size = info['upload_chunk_size']
+            self.upload_chunk_size = upload_chunk_size
+            if args.encrypt and info.get('upload_crypted_chunk_size', encrypted_length(upload_chunk_size)) != \
+                    encrypted_length(upload_chunk_size):
+                raise UploadError(f"the server's encrypted chunks are {info['upload_crypted_chunk_size']} bytes, "
+                                  f"not {encrypted_length(upload_chunk_size)}, its encryption is not supported")
+
+            # ------------------------
+            # test local file output
+
+            self.outprefix = None
+            if args.report:
+                self.outprefix = os.path.abspath(args.report)
+                outdir = os.path.dirname(self.outprefix)
+                try:
+                    os.makedirs(outdir, exist_ok=True)
+                    fout = open(self.outprefix+".test", "w")
+                    fout.write("")
+                    fout.close()
+                    os.remove(self.outprefix + ".test")
+                except Exception as e:
+                    print("""
+###########
+# WARNING #
+###########
+Unable to write output to specified location. Printing to stdout instead
 """)
-    
-
-
-
-
-
-
-
+                    self.outprefix = None
+
+            # chunk journal, keep appending to the same one when resuming
+            self.journal = None
+            journal_path = args.journal
+            if journal_path is None and args.resume:
+                journal_path = args.resume
+            elif journal_path is None and self.outprefix:
+                journal_path = self.outprefix + ".journal"
+
+            self.resume_state = {}
+            if args.resume:
+                self.resume_state = load_journal(args.resume)
+            self.setup_encryption()
+
+            if debug:
+                print('base_url          : '+base_url)
+                print('username          : '+username)
+                print('apikey            : '+apikey)
+                print('upload_chunk_size : '+str(upload_chunk_size)+' bytes')
+                print('recipients        : '+self.settings['recipients'])
+                print('files             : '+','.join(files))
+                print('insecure          : '+str(insecure))
+
+            self.index = None
+            if args.dedup != "off":
+                self.index = UploadIndex(args.dedup_index, base_url)
+            try:
+                self.collect(files)
+                if self.total_files == 0:
+                    # all of it was sent before
+                    self.make_reporter(0).close(self.skipped)
+                    return []
+                return self.send(upload_chunk_size, journal_path, retry_budget, limiter, max_rate)
+            finally:
+                if self.index is not None:
+                    self.index.close()
+        except (HttpError, OSError, aiohttp.ClientError if aiohttp is not None else HttpError) as e:
+            # failed requests and file access, requests' errors are OSErrors too
+            raise UploadError(str(e) or type(e).__name__) from e
+
+    def make_reporter(self, n_sets):
+        args = self.options
+        WRITE_JSON = args.report_json
+        WRITE_NDJSON = args.report_ndjson
+        WRITE_TEXT = args.report_text
+        if not WRITE_JSON and not WRITE_TEXT and not WRITE_NDJSON:
+            WRITE_TEXT = True
+        if args.quiet:
+            WRITE_JSON = WRITE_NDJSON = WRITE_TEXT = False
+        # the checksum manifest is written next to the reports even when quiet
+        checksum = None
+        if args.checksum != "none" and (self.outprefix or not args.quiet):
+            checksum = args.checksum
+        return ReportWriter(self.outprefix, n_sets, WRITE_TEXT, WRITE_JSON, WRITE_NDJSON, checksum,
+                            prepare=self.finish_set)
+
+    def finish_set(self, set_index, response):
+        """completes the response of a transfer for the reports: bundles, compression,
+        earlier uploads, per file throughput and checksums. Its files go into the
+        --dedup index, with the files of this upload that have the same content flagged.
+        """
+        args = self.options
+        files = self.input_sets[set_index][0]
+        if self.encryption is not None:
+            response['encrypted'] = True
+        uploads = []
+        for f in response['files']:
+            entry = files.get(f"{f['name']}:{f['size']}", {})
+            for k in ('members', 'compression'):
+                if k in entry:
+                    f[k] = entry[k]
+            path = entry.get('path')
+            if isinstance(path, str) and path in self.previous:
+                f['previous'] = self.previous[path]
+            if f.get('upload_seconds'):
+                f['upload_bytes_per_second'] = f['size'] / f['upload_seconds']
+            if self.hasher is not None:
+                digest = self.hasher.digest(f['id'])
+                if digest is not None:
+                    f[args.checksum] = digest
+            if self.index is not None:
+                if f['size'] and args.checksum in f:
+                    first = self.seen.setdefault((f['size'], f[args.checksum]), f['name'])
+                    if first != f['name']:
+                        f['duplicate_of'] = first
+                if isinstance(path, str) and path in self.stats:
+                    uploads.append((path, self.stats[path], f, response))
+        if uploads:
+            self.index.record(uploads, max(1, args.hash_threads))
+
+    def chunk_count(self, upload_chunk_size):
+        """chunks of all files at most, an empty file counts as one
+        """
+        return sum(max(1, -(-f['size'] // upload_chunk_size))
+                   for _, filesTransfer in self.input_sets for f in filesTransfer)
+
+    def send(self, upload_chunk_size, journal_path, retry_budget, limiter, max_rate):
+        args = self.options
+        n_sets = len(self.input_sets)
+
+        self.monitor = None
+        if progress or args.metrics:
+            self.monitor = ProgressAggregator(self.total_size, self.total_files, show=progress, metrics=args.metrics,
+                                              metrics_interval=args.metrics_interval)
+        self.compressor = None
+        if args.compress == "zstd":
+            self.compressor = Compressor(args.compress_level, args.compress_threads, args.spool_dir)
+        self.hasher = None
+        if args.checksum != "none":
+            self.hasher = FileHasher(args.checksum, max(1, args.hash_threads))
+        # every transfer is reported once complete, while the next ones upload
+        self.seen = {}
+        self.reporter = self.make_reporter(n_sets)
+
+        # ----------------------------------------------------------------------
+        # transferring data, all sets go through the same workers
+        if args.rate_schedule:
+            RateSchedule(args.rate_schedule, limiter, max_rate).start()
+
+        if journal_path:
+            self.journal = ChunkJournal(journal_path)
+        if self.monitor is not None:
+            self.monitor.start()
+
+        self.responses = {}
+        try:
+            try:
+                if args.engine == "async":
+                    responses, self.worker_stats = asyncio.run(upload_transfers_async(
+                        self.prepare_sets(), upload_chunk_size, args.auto_max if args.auto else args.max_inflight,
+                        args.read_threads, debug, self.journal, retry_budget, args.adaptive, limiter, self.monitor,
+                        self.hasher, args.read_ahead, args.auto, self.total_size, self.reporter))
+                else:
+                    responses, self.worker_stats = upload_transfers(
+                        self.prepare_sets(), upload_chunk_size, args.auto_max if args.auto else args.n_procs, debug,
+                        self.journal, retry_budget, args.adaptive, limiter, self.monitor, self.hasher,
+                        args.read_ahead, args.auto, self.total_size, self.reporter,
+                        self.chunk_count(upload_chunk_size))
+            finally:
+                if self.monitor is not None:
+                    self.monitor.stop()
+                if self.hasher is not None:
+                    # after a failure the hashing threads would wait for chunks forever
+                    self.hasher.stop()
+                if self.journal is not None:
+                    self.journal.close()
+        except BaseException:
+            # the transfers completed so far are reported even if the upload failed,
+            # a failure writing the reports must not hide the upload's own error
+            try:
+                self.reporter.close(self.skipped)
+            except Exception as e:
+                print(f"ERROR: writing the reports failed as well: {e}", file=sys.stderr)
+            raise
+        if debug and self.hasher is not None:
+            print(f"waiting for the {args.checksum} checksums")
+        self.reporter.close(self.skipped)
+        self.responses.update(responses)
+        Responses = [self.responses[n] for n in range(n_sets)]
+
+        if args.connection_stats:
+            stats = merge_connection_stats([connection_stats()] + self.worker_stats)
+            print(f"HTTP connections: {stats['connections']} opened (TCP/TLS handshakes), "
+                  f"{stats['requests']} requests, {stats['reused']} reused")
+        return Responses
+
+
+def main(argv=None):
+    """the command line, a thin wrapper around Uploader
+    """
+    parser = make_parser(read_config())
+    args = parser.parse_args(argv)
+    if args.files_from:
+        fin = sys.stdin if args.files_from == '-' else open(args.files_from)
+        args.files += [line.rstrip('\n') for line in fin if line.strip()]
+    if not args.files:
+        parser.error("no files to send")
+    try:
+        Uploader(**vars(args)).upload()
+    except UploadError as e:
+        print(f"ERROR: {e}")
+        sys.exit(1)
 
 
+if __name__ == "__main__":
+    main()